@@ -1,33 +1,97 @@
 #!/usr/bin/env python3
 
+import queue
+import socket as socket_module
+import threading
+from time import monotonic
 from winbox.common import *
 from winbox.tcpsession import *
 from winbox.message import *
 from winbox.packet import *
 
+# Variable fields of the tcp/udp probe requests: host, port, data to send and to expect
+PROBE_VARIABLES = ((3, U32), (4, U32), (7, STRING), (8, STRING))
+
+# Agent probe commands
+PROBE_TCP		= 1
+PROBE_UDP		= 2
+PROBE_NETBIOS		= 3
+
+# The error of a probe left without a reply within the session timeout
+PROBE_TIMEOUT		= 'timeout'
+
+# The outcome of a single probe of a batch
+class mtProbeResult(object):
+	def __init__(self, spec, command):
+		self.spec = spec
+		self.command = command
+		self.success = False
+		# SYS_ERRNO of the reply (or PROBE_TIMEOUT) and SYS_ERRSTR
+		self.error = None
+		self.error_description = None
+		# Seconds from sending the probe to its reply
+		self.latency = None
+		# The host of the agent which has run the probe (see mtAgentGroup)
+		self.agent = None
+
+	def __repr__(self):
+		return 'mtProbeResult(%r, %r, error %r, %.3fs)' % (self.spec, self.success, self.error, self.latency or 0)
+
+# A thread-safe iterator over the specs shared by the agents of an mtAgentGroup
+class mtSharedSpecs(object):
+	def __init__(self, specs):
+		self.specs = iter(specs)
+		self.lock = threading.Lock()
+
+	def __iter__(self):
+		return self
+
+	def __next__(self):
+		with self.lock:
+			return next(self.specs)
+
 # Implements some of the /nova/bin/agent probes
 class mtAgent(object):
-	# Connect to the agent
-	def __init__(self, host, port):
+	# Connect to the agent, or use the connection of a given (e.g. pooled) winbox session
+	def __init__(self, host, port, winbox_session = None):
 		self.request_id = 0
 		self.error = None
 		self.error_description = None
-		self.session = mtTCPSession(host, port)
-		self.session.connect()
+		if winbox_session is not None:
+			self.session = winbox_session.session
+		else:
+			self.session = mtTCPSession(host, port)
+			self.session.connect()
+		self.host = self.session.host
 		self.result = None
+		self.prepared = {}
 
 	def clear_error(self):
 		self.error = None
 		self.error_description = None
 		self.result = None
 
-	def do_probe(self, msg):
-		self.clear_error()
-		pkt = mtPacket(msg.build())
-		self.session.send(pkt)
-		reply = self.session.recv(1024)
-		self.result = mtMessage(reply.raw)
-		self.result.parse()
+	# Get a prepared probe request for a given agent command
+	def prepare(self, command, variables):
+		prepared = self.prepared.get(command)
+		if prepared is None:
+			msg = mtMessage()
+			msg.set_to(0x68)
+			msg.set_command(command)
+			msg.set_reply_expected(True)
+			prepared = mtPreparedMessage(msg, variables)
+			self.prepared[command] = prepared
+		return prepared
+
+	# Build a probe request for a given agent command
+	def probe_request(self, command, variables, *values):
+		self.request_id = self.session.next_request_id()
+		prepared = self.prepare(command, variables)
+		return mtPacket(prepared.build(self.request_id, *values), self.request_id)
+
+	# Handle a probe reply
+	def probe_reply(self, result):
+		self.result = result
 		error = self.result.get_value(SYS_ERRNO, U32)
 		if error is not None:
 			self.error = error
@@ -38,42 +102,163 @@ class mtAgent(object):
 		elif self.result.get_value(13, BOOL):
 			return True
 
+	# Build a probe request out of a spec: (host, port, send, receive), or a host for PROBE_NETBIOS
+	def spec_request(self, command, spec):
+		if command == PROBE_NETBIOS:
+			host = spec[0] if isinstance(spec, (tuple, list)) else spec
+			return self.probe_request(command, ((3, U32),), ip2dword(host))
+		host, port, send, receive = spec
+		return self.probe_request(command, PROBE_VARIABLES, ip2dword(host), port, send or None, receive or None)
+
+	# Fill a batch result out of a probe reply
+	def spec_result(self, probe, result):
+		probe.error = result.get_value(SYS_ERRNO, U32)
+		if probe.error is not None:
+			probe.error_description = result.get_value(SYS_ERRSTR, STRING)
+		else:
+			probe.success = bool(result.get_value(13, BOOL))
+		return probe
+
+	# Give up the probes in flight with a given error, returns their results
+	def expire(self, in_flight, error):
+		now = monotonic()
+		probes = []
+		for future, (probe, request_id, sent) in in_flight.items():
+			self.session.expire(request_id)
+			probe.error = error
+			probe.latency = now - sent
+			probes.append(probe)
+		return probes
+
+	# Run many probes on the agent session, keeping up to window of them in flight
+	# Yields an mtProbeResult for every spec as its reply comes, not necessarily in order
+	# Probes left without a reply within the session timeout get the PROBE_TIMEOUT error
+	def probe_batch(self, specs, command = PROBE_TCP, window = 64):
+		return self.session.iterate(self.probe_steps(specs, command, window))
+
+	# The steps of probe_batch() (see mtTCPSession.iterate())
+	def probe_steps(self, specs, command, window):
+		specs = iter(specs)
+		in_flight = {}
+		exhausted = False
+		try:
+			while True:
+				while not exhausted and len(in_flight) < window:
+					spec = next(specs, None)
+					if spec is None:
+						exhausted = True
+						break
+					probe = mtProbeResult(spec, command)
+					probe.agent = self.host
+					pkt = self.spec_request(command, spec)
+					# The probes go out in a single write when the window is refilled
+					future = yield (self.session.submit, pkt, False)
+					in_flight[future] = (probe, pkt.request_id, monotonic())
+				if not in_flight:
+					break
+				try:
+					yield (self.session.flush,)
+					yield (self.session.wait_any, list(in_flight))
+				except Exception as e:
+					# A timeout leaves the session usable, the other errors end the batch
+					timed_out = isinstance(e, socket_module.timeout)
+					for probe in self.expire(in_flight, PROBE_TIMEOUT if timed_out else e):
+						yield (None, probe)
+					in_flight = {}
+					if not timed_out:
+						raise
+					continue
+				for future in [future for future in in_flight if future.done()]:
+					probe, request_id, sent = in_flight.pop(future)
+					probe.latency = monotonic() - sent
+					yield (None, self.spec_result(probe, future.result()))
+		finally:
+			# A batch left early gives up the probes still in flight
+			self.expire(in_flight, PROBE_TIMEOUT)
+
+	def do_probe(self, pkt):
+		self.clear_error()
+		return self.probe_reply(self.session.request(pkt))
+
 	def tcp_probe(self, host, port, send, receive):
-		self.request_id += 1
-		msg = mtMessage()
-		msg.set_to(0x68)
-		msg.set_command(1)
-		msg.set_request_id(self.request_id)
-		msg.set_reply_expected(True)
-		msg.add_u32(3, ip2dword(host))
-		msg.add_u32(4, port)
-		if send != b'':
-			msg.add_string(7, send)
-		if receive != b'':
-			msg.add_string(8, receive)
-		return self.do_probe(msg)
+		return self.do_probe(self.probe_request(1, PROBE_VARIABLES, ip2dword(host), port, send or None, receive or None))
 
 	def udp_probe(self, host, port, send, receive):
-		self.request_id += 1
-		msg = mtMessage()
-		msg.set_to(0x68)
-		msg.set_command(2)
-		msg.set_request_id(self.request_id)
-		msg.set_reply_expected(True)
-		msg.add_u32(3, ip2dword(host))
-		msg.add_u32(4, port)
-		if send != b'':
-			msg.add_string(7, send)
-		if receive != b'':
-			msg.add_string(8, receive)
-		return self.do_probe(msg)
+		return self.do_probe(self.probe_request(2, PROBE_VARIABLES, ip2dword(host), port, send or None, receive or None))
 
 	def netbios_probe(self, host):
-		self.request_id += 1
-		msg = mtMessage()
-		msg.set_to(0x68)
-		msg.set_command(3)
-		msg.set_request_id(self.request_id)
-		msg.set_reply_expected(True)
-		msg.add_u32(3, ip2dword(host))
-		return self.do_probe(msg)
+		return self.do_probe(self.probe_request(3, ((3, U32),), ip2dword(host)))
+
+# mtAgent over asyncio, connect() has to be awaited before use
+# The probe methods return coroutines, probe_batch() an async iterator
+class mtAsyncAgent(mtAgent):
+	def __init__(self, host, port):
+		self.request_id = 0
+		self.error = None
+		self.error_description = None
+		self.session = mtAsyncTCPSession(host, port)
+		self.host = host
+		self.result = None
+		self.prepared = {}
+
+	async def connect(self):
+		await self.session.connect()
+
+	async def close(self):
+		await self.session.close()
+
+	async def do_probe(self, pkt):
+		self.clear_error()
+		return self.probe_reply(await self.session.request(pkt))
+
+# Spreads a batch of probes across several agents, each one taking the next spec when it has room
+# in its window, so the faster agents run more of them
+class mtAgentGroup(object):
+	def __init__(self, agents):
+		self.agents = list(agents)
+		# (host, exception) of the agents that failed during the last batch, their specs not yet
+		# taken have gone to the others
+		self.errors = []
+
+	# Run the probes on all the agents, yielding the results as they come
+	# The agents stop probing once the caller stops iterating; the batch raises if all of them fail
+	def probe_batch(self, specs, command = PROBE_TCP, window = 64):
+		shared = mtSharedSpecs(specs)
+		# Bounded, so the agents don't run ahead of a slow caller
+		results = queue.Queue(window * len(self.agents))
+		stopped = threading.Event()
+		def put(result):
+			while not stopped.is_set():
+				try:
+					results.put(result, timeout = 0.1)
+					return True
+				except queue.Full:
+					pass
+			return False
+		def run(agent):
+			try:
+				for probe in agent.probe_batch(shared, command, window):
+					if not put(probe):
+						break
+			except Exception as e:
+				put((agent.host, e))
+			finally:
+				put(None)
+		self.errors = []
+		threads = [threading.Thread(target = run, args = (agent,), daemon = True) for agent in self.agents]
+		for thread in threads:
+			thread.start()
+		running = len(threads)
+		try:
+			while running:
+				result = results.get()
+				if result is None:
+					running -= 1
+				elif isinstance(result, tuple):
+					self.errors.append(result)
+				else:
+					yield result
+		finally:
+			stopped.set()
+		if self.errors and len(self.errors) == len(self.agents):
+			raise self.errors[0][1]
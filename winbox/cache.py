@@ -0,0 +1,229 @@
+#!/usr/bin/env python3
+
+import hashlib
+import json
+import os
+import shutil
+import threading
+from time import time
+from winbox.common import *
+from winbox.filerequest import *
+
+# The bytes hashed by the 'head' verification
+CACHE_HEAD_SIZE		= 32168
+
+# Verification modes: trust the size, compare the first part, or download and compare it all
+VERIFY_NONE		= None
+VERIFY_HEAD		= 'head'
+VERIFY_FULL		= 'full'
+
+# Hash a file, returns the sha256 hex digest of the whole file and of its first CACHE_HEAD_SIZE bytes
+def hash_file(path):
+	digest = hashlib.sha256()
+	head = None
+	with open(path, 'rb') as file:
+		while True:
+			data = file.read(0x10000)
+			if not data:
+				break
+			if head is None:
+				head = hashlib.sha256(data[:CACHE_HEAD_SIZE]).hexdigest()
+			digest.update(data)
+	if head is None:
+		head = hashlib.sha256(b'').hexdigest()
+	return digest.hexdigest(), head
+
+# A file name as text for the index
+def decode_filename(filename):
+	if isinstance(filename, bytes):
+		return filename.decode(errors = 'surrogateescape')
+	return filename
+
+# The outcome of a cached fetch
+class mtCacheResult(object):
+	def __init__(self, key):
+		self.key = key
+		self.path = None
+		# hit is set when the transfer was skipped, changed when the downloaded file differs from the cached one
+		self.hit = False
+		self.changed = False
+		self.size = None
+		self.sha256 = None
+
+	def __repr__(self):
+		return 'mtCacheResult(%r, hit %r, changed %r)' % (self.key, self.hit, self.changed)
+
+# An on-disk cache of downloaded files, keyed by host, port and file name
+# The index is a JSON file next to the data with the size, download time and sha256 of every file
+# The device only tells the file size before the transfer, so a file of the same size is taken as
+# unchanged unless max_age has passed or a verification mode asks for more
+# The least recently used files are evicted to stay within max_entries files and max_size bytes
+class mtDownloadCache(object):
+	def __init__(self, directory, max_size = None, max_entries = None, max_age = None, verify = VERIFY_NONE):
+		self.directory = directory
+		self.data_directory = os.path.join(directory, 'data')
+		self.index_path = os.path.join(directory, 'index.json')
+		self.max_size = max_size
+		self.max_entries = max_entries
+		self.max_age = max_age
+		self.verify = verify
+		self.lock = threading.Lock()
+		os.makedirs(self.data_directory, exist_ok = True)
+		self.index = self.load()
+
+	# Read the index, a missing or broken one means an empty cache
+	def load(self):
+		try:
+			with open(self.index_path, 'r') as file:
+				index = json.load(file)
+		except (OSError, ValueError):
+			return {}
+		# Drop the entries whose data has gone
+		return {key: entry for key, entry in index.items() if os.path.exists(self.data_path(key))}
+
+	# Write the index atomically, the lock has to be held
+	def save(self):
+		temporary = self.index_path + '.tmp'
+		with open(temporary, 'w') as file:
+			json.dump(self.index, file)
+		os.replace(temporary, self.index_path)
+
+	# The cache key of a file
+	def key(self, host, port, filename):
+		return '%s:%s/%s' % (host, port or 8291, decode_filename(filename))
+
+	# The path of the cached data of a key
+	def data_path(self, key):
+		return os.path.join(self.data_directory, hashlib.sha256(key.encode(errors = 'surrogateescape')).hexdigest())
+
+	# Get the index entry of a key, or None
+	def lookup(self, key):
+		with self.lock:
+			entry = self.index.get(key)
+			return dict(entry) if entry is not None else None
+
+	# Mark an entry as used
+	def touch(self, key):
+		with self.lock:
+			entry = self.index.get(key)
+			if entry is not None:
+				entry['accessed'] = time()
+				self.save()
+
+	# Add (or replace) an entry with a downloaded file and evict what doesn't fit
+	def store(self, key, host, filename, temporary):
+		sha256, head = hash_file(temporary)
+		now = time()
+		entry = {
+			'host':		host,
+			'filename':	filename,
+			'size':		os.path.getsize(temporary),
+			'downloaded':	now,
+			'accessed':	now,
+			'sha256':	sha256,
+			'head':		head,
+		}
+		with self.lock:
+			os.replace(temporary, self.data_path(key))
+			self.index[key] = entry
+			self.evict(keep = key)
+			self.save()
+		return entry
+
+	# Evict the least recently used entries beyond the limits, the lock has to be held
+	def evict(self, keep = None):
+		entries = sorted(self.index.items(), key = lambda item: item[1]['accessed'])
+		total = sum(entry['size'] for key, entry in entries)
+		count = len(entries)
+		for key, entry in entries:
+			if (self.max_entries is None or count <= self.max_entries) and (self.max_size is None or total <= self.max_size):
+				break
+			if key == keep:
+				continue
+			try:
+				os.unlink(self.data_path(key))
+			except OSError:
+				pass
+			del self.index[key]
+			total -= entry['size']
+			count -= 1
+
+	# Drop an entry
+	def remove(self, key):
+		with self.lock:
+			if self.index.pop(key, None) is not None:
+				try:
+					os.unlink(self.data_path(key))
+				except OSError:
+					pass
+				self.save()
+
+	# Tell if a cached entry is still good for a file of a given size, without a transfer
+	def fresh(self, entry, file_size):
+		if entry is None or entry['size'] != file_size:
+			return False
+		if self.max_age is not None and time() - entry['downloaded'] > self.max_age:
+			return False
+		return True
+
+	# Compare the first part of the file with the cached one, requests a single part only
+	# and closes the file session, which is not read to the end
+	def head_matches(self, request, entry):
+		request.part_size = min(CACHE_HEAD_SIZE, request.file_size) or CACHE_HEAD_SIZE
+		head = b''
+		try:
+			for part_data in request.iter_parts():
+				head = bytes(part_data)
+				break
+		finally:
+			request.close()
+		return hashlib.sha256(head[:CACHE_HEAD_SIZE]).hexdigest() == entry['head']
+
+	# Get a file through the cache, optionally copying it to a destination path
+	# Returns an mtCacheResult with the path of the cached (or copied) file
+	def fetch(self, winbox_session, filename, destination = None, verify = None, window = 8):
+		if verify is None:
+			verify = self.verify
+		host = winbox_session.session.host
+		key = self.key(host, winbox_session.session.port, filename)
+		result = mtCacheResult(key)
+		entry = self.lookup(key)
+		# Opening the file tells its size before any data moves
+		request = mtFileRequest(winbox_session, filename)
+		if not request.request_download():
+			raise Exception('Error opening %r (error %s %s)' % (filename, request.error, request.error_description))
+		result.size = request.file_size
+		hit = self.fresh(entry, request.file_size)
+		if hit and verify == VERIFY_HEAD:
+			hit = self.head_matches(request, entry)
+			if not hit:
+				# The head has been used up, open the file again for the full download
+				request = mtFileRequest(winbox_session, filename)
+				if not request.request_download():
+					raise Exception('Error opening %r (error %s %s)' % (filename, request.error, request.error_description))
+		if hit and verify != VERIFY_FULL:
+			# Nothing is read, the file session has to be closed
+			request.close()
+			self.touch(key)
+			result.hit = True
+			result.sha256 = entry['sha256']
+		else:
+			temporary = '%s.%d.%d.part' % (self.data_path(key), os.getpid(), threading.get_ident())
+			try:
+				try:
+					request.download_file(temporary, window = window)
+				except Exception:
+					request.close()
+					raise
+				new_entry = self.store(key, host, decode_filename(filename), temporary)
+			finally:
+				if os.path.exists(temporary):
+					os.unlink(temporary)
+			result.sha256 = new_entry['sha256']
+			result.changed = entry is not None and entry['sha256'] != new_entry['sha256']
+		result.path = self.data_path(key)
+		if destination is not None:
+			with self.lock:
+				shutil.copyfile(result.path, destination)
+			result.path = destination
+		return result
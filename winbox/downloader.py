@@ -0,0 +1,207 @@
+#!/usr/bin/env python3
+
+import os
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from time import monotonic
+from winbox.common import *
+from winbox.filerequest import *
+from winbox.pool import *
+
+# Result statuses
+DOWNLOAD_OK		= 'ok'
+DOWNLOAD_ERROR		= 'error'
+
+# Appended to the destination path of a download in progress
+PART_SUFFIX		= '.part'
+
+# A file to download from a device
+# The destination path may refer to {host} and {filename}, e.g. 'backups/{host}/{filename}'
+class mtDownloadJob(object):
+	def __init__(self, host, user, password, filename, destination, port = None):
+		self.host = host
+		self.port = port
+		self.user = user
+		self.password = password
+		self.filename = filename
+		self.destination = destination
+
+	# The local path to download to
+	def path(self):
+		filename = self.filename.decode(errors = 'replace') if isinstance(self.filename, bytes) else self.filename
+		return self.destination.format(host = self.host, filename = os.path.basename(filename))
+
+	def __repr__(self):
+		return 'mtDownloadJob(%r, %r)' % (self.host, self.filename)
+
+# The outcome of a download job
+class mtDownloadResult(object):
+	def __init__(self, job):
+		self.job = job
+		self.status = None
+		self.error = None
+		self.path = None
+		self.file_size = None
+		# Bytes transferred
+		self.size = 0
+		# Set when the file came from an mtDownloadCache without a transfer
+		self.cached = False
+		self.elapsed = None
+
+	def __repr__(self):
+		return 'mtDownloadResult(%r, %r, %d bytes, %.3fs)' % (self.job, self.status, self.size, self.elapsed or 0)
+
+# Downloads files from many devices at once with global and per host limits
+# Sessions come from an mtSessionPool, so several files from a host share its logged in sessions
+class mtDownloadManager(object):
+	def __init__(self, workers = 16, per_host = 2, pool = None, timeout = None, window = 8, progress = None, cache = None):
+		self.workers = workers
+		self.per_host = per_host
+		if pool is None:
+			pool = mtSessionPool(max_per_host = per_host, timeout = timeout)
+		self.pool = pool
+		self.window = window
+		# Called as progress(job, received, file_size) after every part
+		self.progress_callback = progress
+		# An mtDownloadCache to skip the files that haven't changed
+		self.cache = cache
+		self.files_cached = 0
+		self.lock = threading.Lock()
+		self.started = None
+		self.bytes = 0
+		self.files_done = 0
+		self.files_failed = 0
+		# job -> (received, file_size) for the downloads in progress
+		self.active = {}
+
+	# A snapshot of the aggregate progress, throughput is in bytes per second
+	def progress(self):
+		with self.lock:
+			elapsed = monotonic() - self.started if self.started is not None else 0.0
+			return {
+				'files_done':	self.files_done,
+				'files_failed':	self.files_failed,
+				'files_cached':	self.files_cached,
+				'active':	dict(self.active),
+				'bytes':	self.bytes,
+				'elapsed':	elapsed,
+				'throughput':	self.bytes / elapsed if elapsed else 0.0,
+			}
+
+	# Account for a downloaded part
+	def update(self, job, received, file_size, last):
+		with self.lock:
+			self.bytes += received - last[0]
+			self.active[job] = (received, file_size)
+		last[0] = received
+		if self.progress_callback is not None:
+			self.progress_callback(job, received, file_size)
+
+	# Download a single file, never raises
+	def execute(self, job):
+		result = mtDownloadResult(job)
+		started = monotonic()
+		try:
+			result.path = job.path()
+			directory = os.path.dirname(result.path)
+			if directory:
+				os.makedirs(directory, exist_ok = True)
+			if self.cache is not None:
+				return self.execute_cached(job, result, started)
+			with self.pool.borrow(job.host, job.port, job.user, job.password) as session:
+				request = mtFileRequest(session, job.filename)
+				# A file that can't be opened is no reason to drop the session
+				opened = request.request_download()
+				if opened:
+					result.file_size = request.file_size
+					last = [0]
+					def progress(received, file_size):
+						self.update(job, received, file_size, last)
+					# The destination is only replaced once the download is complete
+					partial = result.path + PART_SUFFIX
+					try:
+						request.download_file(partial, window = self.window, progress = progress)
+					except Exception:
+						# Don't leave a file session open on the device
+						request.close()
+						raise
+					os.replace(partial, result.path)
+					result.size = request.received
+			if not opened:
+				raise Exception('Error opening %r (error %s %s)' % (job.filename, request.error, request.error_description))
+			result.status = DOWNLOAD_OK
+		except Exception as e:
+			result.status = DOWNLOAD_ERROR
+			result.error = e
+		return self.finish(result, started)
+
+	# Download a single file through the cache
+	def execute_cached(self, job, result, started):
+		try:
+			with self.pool.borrow(job.host, job.port, job.user, job.password) as session:
+				cached = self.cache.fetch(session, job.filename, result.path, window = self.window)
+			result.file_size = cached.size
+			result.cached = cached.hit
+			if not cached.hit:
+				result.size = cached.size
+				with self.lock:
+					self.bytes += cached.size
+			result.status = DOWNLOAD_OK
+		except Exception as e:
+			result.status = DOWNLOAD_ERROR
+			result.error = e
+		return self.finish(result, started)
+
+	# Account for a finished job
+	def finish(self, result, started):
+		with self.lock:
+			self.active.pop(result.job, None)
+			if result.status == DOWNLOAD_OK:
+				self.files_done += 1
+				if result.cached:
+					self.files_cached += 1
+			else:
+				self.files_failed += 1
+		result.elapsed = monotonic() - started
+		return result
+
+	# Run the jobs, yielding the results as they complete
+	# Jobs are pulled lazily; a bounded backlog holds the ones waiting for a busy host
+	def run(self, jobs):
+		jobs = iter(jobs)
+		executor = ThreadPoolExecutor(self.workers)
+		waiting = deque()
+		in_flight = {}
+		counts = {}
+		exhausted = [False]
+		if self.started is None:
+			self.started = monotonic()
+		def fill():
+			while not exhausted[0] and len(waiting) < self.workers * 4:
+				job = next(jobs, None)
+				if job is None:
+					exhausted[0] = True
+				else:
+					waiting.append(job)
+			for job in list(waiting):
+				if len(in_flight) >= self.workers:
+					break
+				if counts.get(job.host, 0) < self.per_host:
+					waiting.remove(job)
+					counts[job.host] = counts.get(job.host, 0) + 1
+					in_flight[executor.submit(self.execute, job)] = job.host
+		try:
+			fill()
+			while in_flight:
+				done, not_done = wait(list(in_flight), return_when = FIRST_COMPLETED)
+				for future in done:
+					host = in_flight.pop(future)
+					counts[host] -= 1
+				fill()
+				for future in done:
+					yield future.result()
+		finally:
+			for future in in_flight:
+				future.cancel()
+			executor.shutdown(wait = False)
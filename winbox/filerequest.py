@@ -1,40 +1,92 @@
 #!/usr/bin/env python3
 
+import mmap
+import os
+from collections import deque
 from io import BytesIO
-from time import sleep
+from time import monotonic
 from winbox.common import *
 from winbox.packet import *
 
+# Part size limits for the adaptive downloads, a part has to fit into a single M2 message
+MIN_PART_SIZE		= 4096
+MAX_PART_SIZE		= 0xf000
+
+# Make a write(data) function out of a sink: a callable, a file object (or an mmap) positioned
+# by the caller, or a writable buffer such as a bytearray, written starting at offset
+def make_sink(sink, offset = 0):
+	if callable(sink):
+		return sink
+	if hasattr(sink, 'write'):
+		return sink.write
+	view = memoryview(sink).cast('B')
+	position = [offset]
+	def write(data):
+		size = len(data)
+		view[position[0]:position[0]+size] = data
+		position[0] += size
+	return write
+
+# Open a file to download to, an existing one is kept if verify_existing is set
+def open_file_sink(path, file_size, verify_existing, use_mmap):
+	file = open(path, 'r+b' if verify_existing and os.path.exists(path) else 'w+b')
+	if use_mmap:
+		file.truncate(file_size)
+	return file
+
+# Make a write(data) function for a file (or an mmap) already holding a copy of the download,
+# e.g. from an interrupted one: the parts equal to what the file has are not written again,
+# from the first part that differs on everything is written
+def make_verifying_sink(file):
+	matching = [True]
+	def write(data):
+		if matching[0]:
+			position = file.tell()
+			if file.read(len(data)) == data:
+				return
+			matching[0] = False
+			file.seek(position)
+		file.write(data)
+	return write
+
 # Requests a file from a device
 class mtFileRequest(object):
+	# File handler (2, 2) commands
+	CMD_OPEN_READ		= 3
+	CMD_READ		= 4
+	CMD_CLOSE		= 5
+	CMD_OPEN_LIST		= 7
+
 	def __init__(self, winbox_session, filename):
 		self.session = winbox_session.session
 		self.session_id = None
 		self.request_id = winbox_session.request_id
 		self.filename = filename
 		self.file_size = None
-		self.fragment_size = 1460
 		self.part_size = 32168
+		# Measured by the pipelined downloads: the lowest part RTT (seconds) and bytes per second
+		self.rtt = None
+		self.throughput = None
+		# Bytes of the file received by the last download
+		self.received = 0
 		self.buffer = BytesIO()
 		self.error = None
 		self.error_description = None
 
-	# Get ready for a download and the necessary data such as file size and session id
-	def request_download(self):
-		self.request_id += 1
+	# Build a request opening a file: CMD_OPEN_READ for a download, CMD_OPEN_LIST for a 'list' alike download
+	def open_request(self, command):
+		self.request_id = self.session.next_request_id()
 		msg = mtMessage()
 		msg.set_reply_expected(True)
 		msg.set_request_id(self.request_id)
-		msg.set_command(3)
+		msg.set_command(command)
 		msg.add_string(1, self.filename)
 		msg.set_from(0, 8)
 		msg.set_to(2, 2)
-		pkt = mtPacket(msg.build())
-		self.session.send(pkt)
-		reply = self.session.recv(self.fragment_size)
-		result = mtMessage(reply.raw)
-		result.parse()
+		return mtPacket(msg.build(), self.request_id)
 
+	# Handle a reply with the download session id and the file size
+	def open_reply(self, result):
 		self.error = result.get_value(SYS_ERRNO, U32)
 		if self.error == ERROR_FAILED:
 			self.error_description = result.get_value(SYS_ERRSTR, STRING)
@@ -47,70 +99,223 @@ class mtFileRequest(object):
 		self.file_size = result.get_value(2, U32)
 		return True
 
+	# Get ready for a download and the necessary data such as file size and session id
+	def request_download(self):
+		return self.open_reply(self.session.request(self.open_request(self.CMD_OPEN_READ)))
+
 	# Request a file download as like 'list' is requested
 	def request_download_list(self):
-		self.request_id += 1
+		return self.open_reply(self.session.request(self.open_request(self.CMD_OPEN_LIST)))
+
+	# Build a request closing the file session, it gets no reply
+	def close_request(self):
 		msg = mtMessage()
-		msg.set_reply_expected(True)
-		msg.set_request_id(self.request_id)
-		msg.set_command(7)
-		msg.add_string(1, self.filename)
+		msg.set_session_id(self.session_id)
+		msg.set_command(self.CMD_CLOSE)
 		msg.set_from(0, 8)
 		msg.set_to(2, 2)
-		pkt = mtPacket(msg.build())
-		self.session.send(pkt)
-		reply = self.session.recv(self.fragment_size)
-		result = mtMessage(reply.raw)
-		result.parse()
+		return mtPacket(msg.build())
 
-		self.error = result.get_value(SYS_ERRNO, U32)
-		if self.error == ERROR_FAILED:
-			self.error_description = result.get_value(SYS_ERRSTR, STRING)
-			return False
-		elif self.error is not None:
-			return False
-		self.session_id = result.get_value(STD_ID, U32)
-		if self.session_id is None:
-			raise Exception('Error getting download session id')
-		self.file_size = result.get_value(2, U32)
-		return True
+	# Close the file session, a download not read to the end would leave it open on the device
+	def close(self):
+		if self.session_id is not None:
+			self.session.send(self.close_request())
+			self.session_id = None
 
-	# Proceed with download, requesting a file chunk by chunk
-	def download(self):
+	# Prepare a part request for the download session
+	def part_request(self):
 		if self.session_id is None:
 			raise Exception('No session')
 		if self.file_size is None:
 			raise Exception('Haven\'t got a file size')
-		file_done = False
-		while not file_done:
-			self.request_id += 1
-			msg = mtMessage()
-			msg.set_reply_expected(True)
-			msg.set_request_id(self.request_id)
-			msg.set_session_id(self.session_id)
-			msg.add_u32(2, self.part_size)
-			msg.set_command(4)
-			msg.set_from(0, 8)
-			msg.set_to(2, 2)
-			pkt = mtPacket(msg.build())
-			self.session.send(pkt)
-			sleep(0.1)
-			part_buffer = BytesIO()
-			part_done = False
-			while not part_done:
-				data = self.session.recv_bytes(self.fragment_size)
-				data_size = len(data)
-				if data_size < self.fragment_size:
-					part_done = True
-				part_buffer.write(data)
-			unpkt = mtPacket(part_buffer.getvalue())
-			part_buffer.close()
-			unpkt.remove_header()
-			unmsg = mtMessage(unpkt.raw)
-			unmsg.parse()
-			part_data = unmsg.get_value(3, RAW)
-			part_data_size = len(part_data)
-			if part_data_size < self.part_size:
-				file_done = True
+		msg = mtMessage()
+		msg.set_reply_expected(True)
+		msg.set_session_id(self.session_id)
+		msg.set_command(self.CMD_READ)
+		msg.set_from(0, 8)
+		msg.set_to(2, 2)
+		return mtPreparedMessage(msg, ((2, U32),))
+
+	# Build a request for the next part of a given size
+	def part_packet(self, prepared, size):
+		self.request_id = self.session.next_request_id()
+		return mtPacket(prepared.build(self.request_id, size), self.request_id)
+
+	# Handle a reply with a file part
+	def part_reply(self, result):
+		part_data = result.get_view(3, RAW)
+		if part_data is None:
+			self.error = result.get_value(SYS_ERRNO, U32)
+			self.error_description = result.get_value(SYS_ERRSTR, STRING)
+			raise Exception('Error downloading a file part')
+		return part_data
+
+	# Size of the next part request
+	def next_part_size(self, requested):
+		return min(self.part_size, self.file_size - requested)
+
+	# Adjust the part size and the window depth to the measured RTT
+	# Like TCP Vegas: parts queued beyond the base RTT mean the link is busy, otherwise go deeper
+	def adapt(self, rtt, depth, window):
+		if self.rtt is None or rtt < self.rtt:
+			self.rtt = rtt
+		queued = depth * (1 - self.rtt / rtt) if rtt > 0 else 0
+		if queued < 1:
+			if depth < window:
+				depth += 1
+			else:
+				self.part_size = min(self.part_size * 2, MAX_PART_SIZE)
+		elif queued > 3:
+			if depth > 1:
+				depth -= 1
+			else:
+				self.part_size = max(self.part_size // 2, MIN_PART_SIZE)
+		return depth
+
+	# The RTT of a part, from its request to the arrival of its reply (see mtTCPSession.dispatch())
+	# leaving out the caller's turns in between, i.e. the time spent on the sink and the progress
+	# A reply that came during a turn is only read after it, so the RTT comes out too low by up
+	# to the turn; None if the turns are the larger part of it, such a part tells little of the link
+	def part_rtt(self, sent, received, turns):
+		rtt = received - sent
+		overlap = 0.0
+		for turn_started, turn_ended in turns:
+			overlap += max(0.0, min(turn_ended, received) - max(turn_started, sent))
+		if overlap > rtt - overlap:
+			return None
+		return rtt - overlap
+
+	# Forget the caller's turns over before the oldest part in flight was requested
+	def trim_turns(self, turns, in_flight):
+		oldest = in_flight[0][2] if in_flight else monotonic()
+		while turns and turns[0][1] <= oldest:
+			turns.popleft()
+
+	# Yield the parts of a file as they are downloaded, keeping up to window part requests outstanding
+	# Part replies come in the order of the requests, so the parts are yielded in order
+	# With adaptive set, the part size and the window depth follow the measured RTT (self.rtt),
+	# self.throughput is updated as the parts come in and self.received counts the bytes done
+	def iter_parts(self, window = 1, adaptive = False):
+		return self.session.iterate(self.part_steps(window, adaptive))
+
+	# The steps of iter_parts() (see mtTCPSession.iterate())
+	def part_steps(self, window, adaptive):
+		prepared = self.part_request()
+		self.rtt = None
+		self.throughput = None
+		self.received = 0
+		in_flight = deque()
+		# (started, ended) of the caller's turns with the parts
+		turns = deque()
+		depth = min(2, window) if adaptive else window
+		requested = 0
+		started = monotonic()
+		while True:
+			while requested < self.file_size and len(in_flight) < depth:
+				size = self.next_part_size(requested)
+				future = yield (self.session.submit, self.part_packet(prepared, size))
+				in_flight.append((future, size, monotonic()))
+				requested += size
+			if not in_flight:
+				break
+			future, size, sent = in_flight.popleft()
+			part_data = self.part_reply((yield (self.session.wait, future)))
+			now = monotonic()
+			rtt = self.part_rtt(sent, future.received, turns)
+			self.received += len(part_data)
+			yield (None, part_data)
+			turns.append((now, monotonic()))
+			self.trim_turns(turns, in_flight)
+			# The file is shorter than expected, wait for the rest of the replies to keep the session clean
+			if len(part_data) < size:
+				for future, size, sent in in_flight:
+					yield (self.session.wait, future)
+				break
+			if now > started:
+				self.throughput = self.received / (now - started)
+			if adaptive and rtt is not None:
+				depth = self.adapt(rtt, depth, window)
+
+	# Proceed with download, requesting a file part by part
+	def download(self):
+		for part_data in self.iter_parts():
+			self.buffer.write(part_data)
+		return self.buffer.getvalue()
+
+	# Proceed with download, keeping up to window part requests outstanding
+	def download_pipelined(self, window = 8, adaptive = True):
+		for part_data in self.iter_parts(window = window, adaptive = adaptive):
 			self.buffer.write(part_data)
 		return self.buffer.getvalue()
+
+	# Stream a file to a sink (see make_sink()) without holding it in memory
+	# Returns the number of bytes received
+	# progress, if given, is called as progress(received, file_size) after every part
+	def download_to(self, sink, window = 8, adaptive = True, progress = None):
+		write = make_sink(sink)
+		for part_data in self.iter_parts(window, adaptive):
+			write(part_data)
+			if progress is not None:
+				progress(self.received, self.file_size)
+		return self.received
+
+	# Download to a file, returns the number of bytes received
+	# The file handler has no known way to read from an offset, so a download can't be resumed,
+	# the whole file is always transferred. With verify_existing set an existing file is kept and
+	# compared with the download, only the parts that differ from it are written (see
+	# make_verifying_sink()), that saves disk writes and nothing else
+	# With use_mmap the file is preallocated to file_size and written through a memory map
+	def download_file(self, path, verify_existing = False, use_mmap = False, window = 8, adaptive = True, progress = None):
+		return self.session.run(self.download_file_steps(path, verify_existing, use_mmap, window, adaptive, progress))
+
+	# The steps of download_file() (see mtTCPSession.run())
+	def download_file_steps(self, path, verify_existing, use_mmap, window, adaptive, progress):
+		file = open_file_sink(path, self.file_size, verify_existing, use_mmap)
+		self.received = 0
+		try:
+			if use_mmap and self.file_size:
+				with mmap.mmap(file.fileno(), self.file_size) as mapped:
+					yield (self.download_to, make_verifying_sink(mapped) if verify_existing else mapped, window, adaptive, progress)
+					mapped.flush()
+				# The file may have come out shorter than file_size
+				file.truncate(self.received)
+			else:
+				yield (self.download_to, make_verifying_sink(file) if verify_existing else file, window, adaptive, progress)
+				file.truncate()
+		finally:
+			file.close()
+		return self.received
+
+# mtFileRequest over an mtAsyncWinboxSession, iter_parts() gives an async iterator
+class mtAsyncFileRequest(mtFileRequest):
+	async def request_download(self):
+		return self.open_reply(await self.session.request(self.open_request(self.CMD_OPEN_READ)))
+
+	async def request_download_list(self):
+		return self.open_reply(await self.session.request(self.open_request(self.CMD_OPEN_LIST)))
+
+	async def close(self):
+		if self.session_id is not None:
+			await self.session.send(self.close_request())
+			self.session_id = None
+
+	async def download(self):
+		async for part_data in self.iter_parts():
+			self.buffer.write(part_data)
+		return self.buffer.getvalue()
+
+	async def download_pipelined(self, window = 8, adaptive = True):
+		async for part_data in self.iter_parts(window = window, adaptive = adaptive):
+			self.buffer.write(part_data)
+		return self.buffer.getvalue()
+
+	async def download_to(self, sink, window = 8, adaptive = True, progress = None):
+		write = make_sink(sink)
+		async for part_data in self.iter_parts(window, adaptive):
+			write(part_data)
+			if progress is not None:
+				progress(self.received, self.file_size)
+		return self.received
+
+	async def download_file(self, path, verify_existing = False, use_mmap = False, window = 8, adaptive = True, progress = None):
+		return await self.session.run(self.download_file_steps(path, verify_existing, use_mmap, window, adaptive, progress))
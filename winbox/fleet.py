@@ -0,0 +1,156 @@
+#!/usr/bin/env python3
+
+import asyncio
+import itertools
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from time import monotonic
+from winbox.common import *
+from winbox.session import *
+
+# Result statuses
+FLEET_OK		= 'ok'
+FLEET_CONNECT_ERROR	= 'connect error'
+FLEET_LOGIN_ERROR	= 'login error'
+FLEET_ERROR		= 'error'
+
+# A device to run an operation on, user None means no login
+class mtTarget(object):
+	def __init__(self, host, port = None, user = None, password = None):
+		self.host = host
+		self.port = port
+		self.user = user
+		self.password = password
+
+	def __repr__(self):
+		return 'mtTarget(%r, %r)' % (self.host, self.port)
+
+# The outcome of an operation on a single target
+class mtFleetResult(object):
+	def __init__(self, target):
+		self.target = target
+		self.status = None
+		self.result = None
+		self.error = None
+		# Seconds spent connecting and logging in, and in total
+		self.connect_time = None
+		self.elapsed = None
+		# The pid of the worker process (see mtShardedFleet)
+		self.worker = None
+
+	def __repr__(self):
+		return 'mtFleetResult(%r, %r, %.3fs)' % (self.target, self.status, self.elapsed or 0)
+
+# Make an mtTarget out of an mtTarget, a (host, port, user, password) tuple or a host name
+def make_target(target):
+	if isinstance(target, mtTarget):
+		return target
+	if isinstance(target, (tuple, list)):
+		return mtTarget(*target)
+	return mtTarget(target)
+
+# Runs an operation across many devices with bounded concurrency
+# The operation is called as operation(session) with a connected (and logged in) mtWinboxSession
+class mtFleet(object):
+	def __init__(self, workers = 32, timeout = None, pool = None):
+		self.workers = workers
+		self.timeout = timeout
+		self.pool = pool
+
+	# Run the operation on a single target, never raises
+	def execute(self, target, operation):
+		result = mtFleetResult(target)
+		started = monotonic()
+		session = None
+		try:
+			result.status = FLEET_CONNECT_ERROR
+			if self.pool is not None:
+				session = self.pool.checkout(target.host, target.port, target.user, target.password)
+			else:
+				session = mtWinboxSession(target.host, target.port, timeout = self.timeout)
+				if target.user is not None:
+					result.status = FLEET_LOGIN_ERROR
+					if session.login_fast(target.user, target.password)[0] is None:
+						raise Exception('Login failed (error %s)' % session.error)
+			result.connect_time = monotonic() - started
+			result.status = FLEET_ERROR
+			result.result = operation(session)
+			result.status = FLEET_OK
+		except Exception as e:
+			result.error = e
+		finally:
+			if session is not None:
+				if self.pool is None:
+					session.close()
+				elif result.status == FLEET_OK:
+					self.pool.release(session)
+				else:
+					self.pool.discard(session)
+		result.elapsed = monotonic() - started
+		return result
+
+	# Run the operation on every target, yielding the results as they complete
+	# Targets are consumed lazily, so only about 2 * workers of them are held at once
+	def run(self, targets, operation):
+		targets = (make_target(target) for target in targets)
+		executor = ThreadPoolExecutor(self.workers)
+		in_flight = set()
+		try:
+			for target in itertools.islice(targets, self.workers * 2):
+				in_flight.add(executor.submit(self.execute, target, operation))
+			while in_flight:
+				done, in_flight = wait(in_flight, return_when = FIRST_COMPLETED)
+				for future in done:
+					for target in itertools.islice(targets, 1):
+						in_flight.add(executor.submit(self.execute, target, operation))
+					yield future.result()
+		finally:
+			for future in in_flight:
+				future.cancel()
+			executor.shutdown(wait = False)
+
+# Runs an async operation across many devices in one event loop
+# The operation is called as await operation(session) with a connected (and logged in) mtAsyncWinboxSession
+class mtAsyncFleet(object):
+	def __init__(self, concurrency = 1000, timeout = None):
+		self.concurrency = concurrency
+		self.timeout = timeout
+
+	# Run the operation on a single target, never raises
+	async def execute(self, target, operation):
+		result = mtFleetResult(target)
+		started = monotonic()
+		session = mtAsyncWinboxSession(target.host, target.port, timeout = self.timeout)
+		try:
+			result.status = FLEET_CONNECT_ERROR
+			await session.connect()
+			if target.user is not None:
+				result.status = FLEET_LOGIN_ERROR
+				if (await session.login_fast(target.user, target.password))[0] is None:
+					raise Exception('Login failed (error %s)' % session.error)
+			result.connect_time = monotonic() - started
+			result.status = FLEET_ERROR
+			result.result = await operation(session)
+			result.status = FLEET_OK
+		except Exception as e:
+			result.error = e
+		finally:
+			await session.close()
+		result.elapsed = monotonic() - started
+		return result
+
+	# Run the operation on every target, yielding the results as they complete
+	async def run(self, targets, operation):
+		targets = (make_target(target) for target in targets)
+		in_flight = set()
+		try:
+			for target in itertools.islice(targets, self.concurrency):
+				in_flight.add(asyncio.ensure_future(self.execute(target, operation)))
+			while in_flight:
+				done, in_flight = await asyncio.wait(in_flight, return_when = asyncio.FIRST_COMPLETED)
+				for task in done:
+					for target in itertools.islice(targets, 1):
+						in_flight.add(asyncio.ensure_future(self.execute(target, operation)))
+					yield task.result()
+		finally:
+			for task in in_flight:
+				task.cancel()
@@ -0,0 +1,121 @@
+#!/usr/bin/env python3
+
+import asyncio
+import threading
+from winbox.common import *
+from winbox.session import *
+
+# Keeps sessions, and the idle sessions of mtSessionPools, warm from a background thread
+# Every interval seconds the sessions quiet for that long are pinged, the dead ones are
+# reconnected and logged in again; TCP keepalives catch the dead connections in between
+class mtKeepalive(object):
+	def __init__(self, interval = 30, tcp_keepalive = True):
+		self.interval = interval
+		self.tcp_keepalive = tcp_keepalive
+		self.sessions = []
+		self.pools = []
+		self.lock = threading.Lock()
+		self.stopped = threading.Event()
+		self.thread = None
+		# Rounds done and sessions that couldn't be brought back
+		self.rounds = 0
+		self.failures = 0
+
+	# Keep a session warm
+	def add(self, session):
+		if self.tcp_keepalive:
+			session.session.set_keepalive()
+		with self.lock:
+			self.sessions.append(session)
+
+	def remove(self, session):
+		with self.lock:
+			if session in self.sessions:
+				self.sessions.remove(session)
+
+	# Keep the idle sessions of a pool warm
+	def add_pool(self, pool):
+		with self.lock:
+			self.pools.append(pool)
+
+	# Check all the sessions once, returns the number of the ones that are down
+	def check(self):
+		with self.lock:
+			sessions = list(self.sessions)
+			pools = list(self.pools)
+		failed = 0
+		for session in sessions:
+			if not session.ensure_alive(self.interval):
+				failed += 1
+		for pool in pools:
+			pool.warm(self.interval)
+		self.rounds += 1
+		self.failures += failed
+		return failed
+
+	def run(self):
+		while not self.stopped.wait(self.interval):
+			self.check()
+
+	def start(self):
+		if self.thread is not None:
+			raise Exception('Already started')
+		self.stopped.clear()
+		self.thread = threading.Thread(target = self.run, daemon = True)
+		self.thread.start()
+
+	def stop(self):
+		self.stopped.set()
+		if self.thread is not None:
+			self.thread.join()
+			self.thread = None
+
+	def __enter__(self):
+		self.start()
+		return self
+
+	def __exit__(self, *exc_info):
+		self.stop()
+
+# mtKeepalive for mtAsyncWinboxSessions, running as a task of the event loop
+class mtAsyncKeepalive(mtKeepalive):
+	def __init__(self, interval = 30, tcp_keepalive = True):
+		super().__init__(interval, tcp_keepalive)
+		self.task = None
+
+	def add_pool(self, pool):
+		raise Exception('Pools hold synchronous sessions, use mtKeepalive')
+
+	async def check(self):
+		sessions = list(self.sessions)
+		results = await asyncio.gather(*(session.ensure_alive(self.interval) for session in sessions))
+		failed = results.count(False)
+		self.rounds += 1
+		self.failures += failed
+		return failed
+
+	async def run(self):
+		while True:
+			await asyncio.sleep(self.interval)
+			await self.check()
+
+	def start(self):
+		if self.task is not None:
+			raise Exception('Already started')
+		self.task = asyncio.ensure_future(self.run())
+
+	async def stop(self):
+		if self.task is not None:
+			self.task.cancel()
+			try:
+				await self.task
+			except asyncio.CancelledError:
+				pass
+			self.task = None
+
+	async def __aenter__(self):
+		self.start()
+		return self
+
+	async def __aexit__(self, *exc_info):
+		await self.stop()
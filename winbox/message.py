@@ -1,9 +1,82 @@
 #!/usr/bin/env python3
 
 import struct
+import sys
+from array import array
 from io import BytesIO
 from winbox.common import *
 
+try:
+	import numpy as numpy_module
+except ImportError:
+	numpy_module = None
+
+# Precompiled codecs for the fixed size values
+U16_STRUCT = struct.Struct('<H')
+U32_STRUCT = struct.Struct('<I')
+U64_STRUCT = struct.Struct('<Q')
+
+# Find an array.array typecode for a given element size
+def array_typecode(size):
+	for typecode in 'BHILQ':
+		if array(typecode).itemsize == size:
+			return typecode
+	raise Exception('No array typecode for %d byte elements' % size)
+
+# Fixed size array element types with their array.array typecodes and struct/NumPy formats
+ARRAY_TYPECODE = {
+	BOOL:	array_typecode(1),
+	U32:	array_typecode(4),
+	U64:	array_typecode(8),
+}
+
+ARRAY_FORMAT = {
+	BOOL:	'B',
+	U32:	'I',
+	U64:	'Q',
+}
+
+NUMPY_DTYPE = {
+	BOOL:	'u1',
+	U32:	'<u4',
+	U64:	'<u8',
+}
+
+BIG_ENDIAN = sys.byteorder == 'big'
+
+# Encode the elements of an array in bulk
+def encode_array(elements_type, value):
+	if elements_type in ARRAY_TYPECODE:
+		if isinstance(value, array) and value.typecode == ARRAY_TYPECODE[elements_type] and not BIG_ENDIAN:
+			return value.tobytes()
+		return struct.pack('<%d%s' % (len(value), ARRAY_FORMAT[elements_type]), *value)
+	elif elements_type == ADDR6:
+		return b''.join(value)
+	elif elements_type == STRING or elements_type == RAW:
+		elements = []
+		for element in value:
+			elements.append(U16_STRUCT.pack(len(element)))
+			elements.append(element)
+		return b''.join(elements)
+	elif elements_type == MESSAGE:
+		elements = []
+		for element in value:
+			element_bytes = element.build()
+			elements.append(U16_STRUCT.pack(len(element_bytes) + 2) + M2_HEADER)
+			elements.append(element_bytes)
+		return b''.join(elements)
+	raise Exception('Array type %s not implemented yet!' % hex(ARRAY | elements_type))
+
+# Decode the elements of a fixed size array in bulk
+def decode_fixed_array(elements_type, data, numpy = False):
+	if numpy:
+		return numpy_module.frombuffer(data, dtype = NUMPY_DTYPE[elements_type])
+	values = array(ARRAY_TYPECODE[elements_type])
+	values.frombytes(data)
+	if BIG_ENDIAN:
+		values.byteswap()
+	return values
+
 # mtMessage represents a Message protocol sequence
 class mtMessage(object):
 	def __init__(self, raw = None, parsed = False):
@@ -11,12 +84,18 @@ class mtMessage(object):
 		self.raw = raw
 		self.ready = False
 		self.parsed = parsed
+		self.lazy = False
+		self.numpy = False
+		self.index = {}
 
 	# Clean up a bit, so the object can be reused again
 	def clear(self):
 		self.contents = []
 		self.raw = None
 		self.parsed = False
+		self.lazy = False
+		self.numpy = False
+		self.index = {}
 
 	# Add an arbitrary id/type/value to a sequence
 	def add(self, id, type, value):
@@ -34,10 +113,26 @@ class mtMessage(object):
 	def add_u32_array(self, id, value):
 		self.add(id, U32_ARRAY, value)
 
+	# Add an array of booleans
+	def add_bool_array(self, id, value):
+		self.add(id, BOOL_ARRAY, value)
+
 	# Add a long integer (u64)
 	def add_u64(self, id, value):
 		self.add(id, U64, value)
 
+	# Add an array of u64 integers
+	def add_u64_array(self, id, value):
+		self.add(id, U64_ARRAY, value)
+
+	# Add an IPv6 address (16 bytes)
+	def add_addr6(self, id, value):
+		self.add(id, ADDR6, value)
+
+	# Add an array of IPv6 addresses
+	def add_addr6_array(self, id, value):
+		self.add(id, ADDR6_ARRAY, value)
+
 	# Add a string (a sequence of bytes, not a native python string)
 	def add_string(self, id, value):
 		self.add(id, STRING, value)
@@ -46,6 +141,14 @@ class mtMessage(object):
 	def add_raw(self, id, value):
 		self.add(id, RAW, value)
 
+	# Add an array of strings
+	def add_string_array(self, id, value):
+		self.add(id, STRING_ARRAY, value)
+
+	# Add an array of raw data
+	def add_raw_array(self, id, value):
+		self.add(id, RAW_ARRAY, value)
+
 	# Set a raw binary contents
 	def set_raw(self, raw):
 		self.raw = raw
@@ -91,12 +194,54 @@ class mtMessage(object):
 	def get_value(self, get_id, get_type):
 		if not self.parsed:
 			raise Exception('Not parsed yet')
+		if self.lazy:
+			entry = self.index.get((get_id, get_type))
+			if entry is None:
+				return None
+			return self.decode(*entry)
 		for k in self.contents:
 			id, type, value = k
 			if id == get_id and type == get_type:
 				return value
 		return None
 
+	# Get a value as get_value() does, but a RAW value (or the elements of a RAW array) of a lazily
+	# parsed message comes as a memoryview into the raw message instead of a copy
+	def get_view(self, get_id, get_type):
+		if not self.parsed:
+			raise Exception('Not parsed yet')
+		if self.lazy:
+			entry = self.index.get((get_id, get_type))
+			if entry is None:
+				return None
+			return self.decode(*entry, view = True)
+		return self.get_value(get_id, get_type)
+
+	# Get values for several (id, type) pairs at once, None for the missing ones
+	def get_many(self, *keys):
+		if not self.parsed:
+			raise Exception('Not parsed yet')
+		if self.lazy:
+			return [self.get_value(id, type) for id, type in keys]
+		wanted = {}
+		for i, key in enumerate(keys):
+			wanted.setdefault(key, []).append(i)
+		values = [None] * len(keys)
+		for id, type, value in self.contents:
+			positions = wanted.pop((id, type), None)
+			if positions is not None:
+				for i in positions:
+					values[i] = value
+				if not wanted:
+					break
+		return values
+
+	# Return all the (id, type, value) sequences, decoding them if parsed lazily
+	def items(self):
+		if not self.lazy:
+			return self.contents
+		return [(typeid & NAME_FILTER, typeid & TYPE_FILTER, self.decode(typeid, offset, length)) for typeid, offset, length in self.scan()]
+
 	# Return True if there is a sequence with a given id/type (with any value)
 	def has_value(self, id, type):
 		if self.get_value(id, type) is not None:
@@ -114,22 +259,7 @@ class mtMessage(object):
 				size = len(value)
 				size_bytes = struct.pack('<H', size)
 				elements_type = type & ARRAY_FILTER
-				value_bytes = b''
-				if elements_type == BOOL:
-					for element in value:
-						value_bytes += struct.pack('<B', element)
-				elif elements_type == U32:
-					for element in value:
-						value_bytes += struct.pack('<I', element)
-				elif elements_type == U64:
-					for element in value:
-						value_bytes += struct.pack('<Q', element)
-				elif elements_type == MESSAGE:
-					header_bytes = b''
-					for element in value:
-						element_bytes = element.build()
-						element_size_bytes = struct.pack('<H', len(element_bytes) + 2)
-						value_bytes += element_size_bytes + M2_HEADER + element_bytes
+				value_bytes = encode_array(elements_type, value)
 			if type == BOOL:
 				size_bytes = b''
 				value_bytes = b''
@@ -144,6 +274,9 @@ class mtMessage(object):
 			elif type == U64:
 				size_bytes = b''
 				value_bytes = struct.pack('<Q', value)
+			elif type == ADDR6:
+				size_bytes = b''
+				value_bytes = bytes(value)
 			elif type == STRING or type == RAW:
 				size = len(value)
 				if size < 256:
@@ -165,7 +298,7 @@ class mtMessage(object):
 
 	# Dump a sequence (for debugging purposes)
 	def dump(self):
-		for i in self.contents:
+		for i in self.items():
 			id, type, value = i
 			if type == MESSAGE_ARRAY:
 				print('%s%s:%s' % (TYPE_REDUCTION[type], hex(id)[2:], value))
@@ -177,100 +310,222 @@ class mtMessage(object):
 			else:
 				print('%s%s:%s' % (TYPE_REDUCTION[type], hex(id)[2:], value))
 
-	# Make a Message sequence from a raw binary data
-	def parse(self):
+	# Walk over a raw sequence yielding (typeid, offset, length) for every value without decoding it
+	def scan(self):
 		if self.raw is None:
 			raise Exception('No raw data')
+		raw = self.raw
+		end = len(raw)
 		pointer = 0
-		while pointer + 4 < len(self.raw):
-			typeid, = struct.unpack('<I', self.raw[pointer:pointer+4])
+		while pointer + 4 <= end:
+			typeid, = U32_STRUCT.unpack_from(raw, pointer)
 			type = typeid & TYPE_FILTER
-			id = typeid & NAME_FILTER
-			short = (typeid & SHORTLEN) >> 24
-			array = (typeid & ARRAY) >> 31
+			short = typeid & SHORTLEN
 			pointer += 4
-			if array:
+			if typeid & ARRAY:
 				if short:
-					array_length, = struct.unpack('<B', self.raw[pointer:pointer+1])
+					array_length = raw[pointer]
 					pointer += 1
 				else:
-					array_length, = struct.unpack('<H', self.raw[pointer:pointer+2])
+					array_length, = U16_STRUCT.unpack_from(raw, pointer)
 					pointer += 2
-				element_type = typeid & ARRAY_FILTER
-				i = 0
-				array_contents = []
 				elements_type = type & ARRAY_FILTER
-				while i < array_length:
-					if elements_type == BOOL:
-						element_value, = struct.unpack('<B', self.raw[pointer:pointer+TYPE_SIZE[BOOL]])
-						array_contents.append(element_value)
-						pointer += TYPE_SIZE[BOOL]
-					if elements_type == U32:
-						element_value, = struct.unpack('<I', self.raw[pointer:pointer+TYPE_SIZE[U32]])
-						array_contents.append(element_value)
-						pointer += TYPE_SIZE[U32]
-					# Treat M2 array as a raw data
-					elif elements_type == MESSAGE:
-						element_length, = struct.unpack('<H', self.raw[pointer:pointer+2])
-						pointer += 2
-						subheader = self.raw[pointer:pointer+2]
-						if subheader != M2_HEADER:
-							raise Exception('Not an M2 header in the array element')
-						pointer += 2
-						element_raw_value = self.raw[pointer:pointer+element_length-2]
-						submessage = mtMessage(element_raw_value)
-						submessage.parse()
-						pointer += (element_length - 2)
-						array_contents.append(submessage.contents)
-					i += 1
-				self.add(id, type, array_contents)
+				element_size = TYPE_SIZE.get(elements_type)
+				if element_size is None:
+					raise Exception('Typeid %s not implemented yet!' % hex(typeid))
+				if element_size:
+					length = array_length * element_size
+				# Variable sized elements are prefixed by their 16-bit length
+				else:
+					length = 0
+					for i in range(array_length):
+						element_length, = U16_STRUCT.unpack_from(raw, pointer + length)
+						length += 2 + element_length
+			elif type == BOOL:
+				length = 0
+			elif type == U32:
+				length = 1 if short else 4
+			elif type == U64 or type == ADDR6:
+				length = TYPE_SIZE[type]
+			elif type == STRING or type == RAW or type == MESSAGE:
+				if short:
+					length = raw[pointer]
+					pointer += 1
+				else:
+					length, = U16_STRUCT.unpack_from(raw, pointer)
+					pointer += 2
 			else:
-				if type == BOOL:
-					value = (typeid & BOOL_FILTER) >> 24
-					self.add(id, type, value)
-				elif type == U32:
-					if short:
-						value, = struct.unpack('<B', self.raw[pointer:pointer+1])
-						pointer += 1
-					else:
-						value, = struct.unpack('<I', self.raw[pointer:pointer+TYPE_SIZE[U32]])
-						pointer += TYPE_SIZE[U32]
-					self.add(id, type, value)
-				elif type == U64:
-					value, = struct.unpack('<Q', self.raw[pointer:pointer+TYPE_SIZE[U64]])
-					pointer += TYPE_SIZE[U64]
-					self.add(id, type, value)
-				elif type == STRING:
-					if short:
-						string_length, = struct.unpack('<B', self.raw[pointer:pointer+1])
-						pointer += 1
-					else:
-						string_length, = struct.unpack('<H', self.raw[pointer:pointer+2])
-						pointer += 2
-					value = self.raw[pointer:pointer+string_length]
-					pointer += string_length
-					self.add(id, type, value)
-				elif type == RAW:
-					if short:
-						raw_length, = struct.unpack('<B', self.raw[pointer:pointer+1])
-						pointer += 1
+				raise Exception('Typeid %s not implemented yet!' % hex(typeid))
+			if pointer + length > end:
+				raise Exception('Truncated value of typeid %s' % hex(typeid))
+			yield typeid, pointer, length
+			pointer += length
+
+	# Decode a single value located by scan(), RAW values are returned as memoryviews if view is set
+	def decode(self, typeid, offset, length, view = False):
+		raw = self.raw
+		type = typeid & TYPE_FILTER
+		if typeid & ARRAY:
+			elements_type = type & ARRAY_FILTER
+			if elements_type in ARRAY_TYPECODE:
+				return decode_fixed_array(elements_type, raw[offset:offset+length], self.numpy)
+			array_contents = []
+			pointer = offset
+			end = offset + length
+			while pointer < end:
+				if elements_type == ADDR6:
+					array_contents.append(bytes(raw[pointer:pointer+TYPE_SIZE[ADDR6]]))
+					pointer += TYPE_SIZE[ADDR6]
+					continue
+				element_length, = U16_STRUCT.unpack_from(raw, pointer)
+				pointer += 2
+				if elements_type == STRING:
+					array_contents.append(bytes(raw[pointer:pointer+element_length]))
+				elif elements_type == RAW:
+					if view:
+						array_contents.append(memoryview(raw)[pointer:pointer+element_length])
 					else:
-						raw_length, = struct.unpack('<H', self.raw[pointer:pointer+2])
-						pointer += 2
-					value = self.raw[pointer:pointer+raw_length]
-					pointer += raw_length
-					self.add(id, type, value)
-				elif type == MESSAGE:
-					message_length, = struct.unpack('<H', self.raw[pointer:pointer+2])
-					pointer += 2
-					subheader = self.raw[pointer:pointer+2]
-					if subheader != M2_HEADER:
-						raise Exception('Not an M2 header!')
-					pointer += 2
-					submessage = mtMessage(self.raw[pointer:pointer+message_length])
-					pointer += message_length
-					submessage.parse()
-					self.add(it, type, submessage.contents)
+						array_contents.append(bytes(raw[pointer:pointer+element_length]))
+				# Treat M2 array as a raw data
+				elif elements_type == MESSAGE:
+					array_contents.append(self.decode_message(pointer, element_length))
 				else:
 					raise Exception('Typeid %s not implemented yet!' % hex(typeid))
+				pointer += element_length
+			return array_contents
+		if type == BOOL:
+			return (typeid & BOOL_FILTER) >> 24
+		elif type == U32:
+			if length == 1:
+				return raw[offset]
+			value, = U32_STRUCT.unpack_from(raw, offset)
+			return value
+		elif type == U64:
+			value, = U64_STRUCT.unpack_from(raw, offset)
+			return value
+		elif type == RAW and view:
+			return memoryview(raw)[offset:offset+length]
+		elif type == STRING or type == RAW or type == ADDR6:
+			return bytes(raw[offset:offset+length])
+		elif type == MESSAGE:
+			return self.decode_message(offset, length)
+		raise Exception('Typeid %s not implemented yet!' % hex(typeid))
+
+	# Decode an embedded M2 message (the length covers the M2 header as well)
+	def decode_message(self, offset, length):
+		if self.raw[offset:offset+2] != M2_HEADER:
+			raise Exception('Not an M2 header!')
+		submessage = mtMessage(self.raw[offset+2:offset+length])
+		submessage.parse(numpy = self.numpy)
+		return submessage.contents
+
+	# Yield the elements of a MESSAGE_ARRAY one at a time, each as an mtMessage parsed lazily over
+	# its slice of the buffer, so no list of the elements is built; works on an unparsed message too
+	def iter_messages(self, get_id):
+		entry = None
+		if self.parsed and self.lazy:
+			entry = self.index.get((get_id, MESSAGE_ARRAY))
+		else:
+			for typeid, offset, length in self.scan():
+				if typeid & NAME_FILTER == get_id and typeid & TYPE_FILTER == MESSAGE_ARRAY:
+					entry = (typeid, offset, length)
+					break
+		if entry is None:
+			return
+		typeid, offset, length = entry
+		raw = memoryview(self.raw)
+		pointer = offset
+		end = offset + length
+		while pointer < end:
+			element_length, = U16_STRUCT.unpack_from(raw, pointer)
+			pointer += 2
+			if raw[pointer:pointer+2] != M2_HEADER:
+				raise Exception('Not an M2 header!')
+			submessage = mtMessage(raw[pointer+2:pointer+element_length])
+			submessage.parse(lazy = True, numpy = self.numpy)
+			yield submessage
+			pointer += element_length
+
+	# Make a Message sequence from a raw binary data
+	# A lazy parse only indexes the values by (id, type) over a memoryview and decodes them on access,
+	# the values are copies as with a full parse, get_view() gives the RAW ones without copying
+	# Fixed size arrays are decoded into array.array, or into NumPy views if numpy is True
+	def parse(self, lazy = False, numpy = False):
+		if self.raw is None:
+			raise Exception('No raw data')
+		if numpy and numpy_module is None:
+			raise Exception('NumPy is not available')
+		self.contents = []
+		self.index = {}
+		self.lazy = lazy
+		self.numpy = numpy
+		if lazy:
+			self.raw = memoryview(self.raw)
+			for entry in self.scan():
+				typeid = entry[0]
+				self.index.setdefault((typeid & NAME_FILTER, typeid & TYPE_FILTER), entry)
+		else:
+			for typeid, offset, length in self.scan():
+				self.add(typeid & NAME_FILTER, typeid & TYPE_FILTER, self.decode(typeid, offset, length))
 		self.parsed = True
+
+# A message with its constant part encoded once, the request id and the variable
+# fields are patched into a preallocated buffer on every build()
+class mtPreparedMessage(object):
+	def __init__(self, msg, variables = ()):
+		self.buffer = bytearray(msg.build())
+		self.slots = []
+		self.request_id_slot = self.reserve(SYS_REQID, U32)
+		for id, type in variables:
+			if type == U32 or type == U64 or type == BOOL:
+				self.slots.append(self.reserve(id, type))
+			elif type == STRING or type == RAW:
+				self.slots.append((id | type, None, None))
+			else:
+				raise Exception('Type %s can not be prepared' % hex(type))
+
+	# Append a fixed width placeholder to the buffer, returning its (typeid, offset, codec) slot
+	def reserve(self, id, type):
+		typeid = id | type
+		offset = len(self.buffer)
+		self.buffer += U32_STRUCT.pack(typeid)
+		if type == U32:
+			codec = U32_STRUCT
+		elif type == U64:
+			codec = U64_STRUCT
+		else:
+			codec = None
+		if codec is not None:
+			self.buffer += bytes(codec.size)
+		return (typeid, offset, codec)
+
+	# Patch a fixed width value in place
+	def patch(self, slot, value):
+		typeid, offset, codec = slot
+		# A boolean value lives in the typeid itself
+		if codec is None:
+			U32_STRUCT.pack_into(self.buffer, offset, typeid | (value << 24))
+		else:
+			codec.pack_into(self.buffer, offset + 4, value)
+
+	# Make a binary representation for a given request id and variable values
+	# Variable length values (STRING/RAW) set to None are omitted
+	def build(self, request_id, *values):
+		if len(values) != len(self.slots):
+			raise Exception('Expected %d values, got %d' % (len(self.slots), len(values)))
+		self.patch(self.request_id_slot, request_id)
+		tail = []
+		for slot, value in zip(self.slots, values):
+			typeid, offset, codec = slot
+			if offset is not None:
+				self.patch(slot, value)
+			elif value is not None:
+				size = len(value)
+				if size < 256:
+					tail.append(U32_STRUCT.pack(typeid | SHORTLEN) + bytes((size,)))
+				else:
+					tail.append(U32_STRUCT.pack(typeid) + U16_STRUCT.pack(size))
+				tail.append(value)
+		if not tail:
+			return bytes(self.buffer)
+		return b''.join([self.buffer] + tail)
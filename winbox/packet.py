@@ -1,15 +1,55 @@
 #!/usr/bin/env python3
 
 import struct
-from io import BytesIO
+from collections import deque
 from winbox.common import *
 from winbox.message import *
 
+# The message length ahead of the M2 header is big endian
+BIG_LENGTH_STRUCT = struct.Struct('>H')
+
+# The header of a full continuation chunk
+FULL_CHUNK_HEADER = b'\xff\xff'
+
+# Split the payload buffers into chunks up to 255 bytes prepended by the M2 header,
+# returning a list of chunk headers interleaved with the payload slices
+def frame_buffers(payload):
+	views = [memoryview(buffer).cast('B') for buffer in payload]
+	size = sum(len(view) for view in views)
+	if size + 2 > 0xffff:
+		raise Exception('The contents is too long for a single message')
+	views.insert(0, memoryview(BIG_LENGTH_STRUCT.pack(size + 2) + M2_HEADER))
+	result = []
+	remaining = size + 4
+	chunk_next = 0x01
+	index = 0
+	pointer = 0
+	while remaining:
+		chunk_size = min(remaining, 0xff)
+		if chunk_size == 0xff and chunk_next == 0xff:
+			result.append(FULL_CHUNK_HEADER)
+		else:
+			result.append(bytes((chunk_size, chunk_next)))
+		remaining -= chunk_size
+		chunk_next = 0xff
+		while chunk_size:
+			view = views[index]
+			take = min(chunk_size, len(view) - pointer)
+			if take:
+				result.append(view[pointer:pointer+take])
+			pointer += take
+			chunk_size -= take
+			if pointer == len(view):
+				index += 1
+				pointer = 0
+	return result
+
 # This class represents a network packet
 class mtPacket(object):
-	def __init__(self, raw = None):
+	def __init__(self, raw = None, request_id = None):
 		self.raw = raw
 		self.header = False
+		self.request_id = request_id
 
 	def size(self):
 		return len(self.raw)
@@ -28,61 +68,100 @@ class mtPacket(object):
 	def add_header(self):
 		if self.has_header():
 			raise Exception('The raw data already has got a header')
-		buffer = BytesIO()
-		size = len(self.raw)
-		# The contents is short (doesn't exceed 255 bytes)
-		if size + 4 < 0xff:
-			buffer.write(struct.pack('<B', size + 4) + b'\x01' + struct.pack('>H', size + 2) + M2_HEADER)
-			buffer.write(self.raw)
-		# The contents is long (so split it into several chunks up to 255 bytes)
-		else:
-			raw_headed = struct.pack('>H', size + 2) + M2_HEADER + self.raw
-			first_chunk = True
-			pointer = 0
-			while pointer < size + 4:
-				remaining = 4 + size - pointer
-				if remaining > 0xff:
-					remaining = 0xff
-				if first_chunk:
-					insertion = struct.pack('<BB', remaining, 0x01)
-					first_chunk = False
-				else:
-					insertion = struct.pack('<BB', remaining, 0xff)
-				buffer.write(insertion + raw_headed[pointer:pointer+remaining])
-				pointer += remaining
-		self.raw = buffer.getvalue()
+		self.raw = b''.join(frame_buffers([self.raw]))
 		self.header = True
 		return self.raw
 
+	# Returns the list of buffers to send, the payload is sliced and not copied
+	def buffers(self):
+		if self.header:
+			return [self.raw]
+		return frame_buffers([self.raw])
+
 	# Remove a M2 header
 	def remove_header(self):
 		if not self.has_header():
 			raise Exception('Not an M2 packet')
-		buffer = BytesIO()
-		length, start, = struct.unpack('<BB', self.raw[0:2])
-		if start != 0x01:
+		decoder = mtStreamDecoder()
+		decoder.feed(self.raw)
+		if len(decoder.messages) != 1 or decoder.started or decoder.header:
 			raise Exception('Incorrect packet')
-		if length < 0xff:
-			buffer.write(self.raw[2:2+length])
-		else:
-			big_length, = struct.unpack('>H', self.raw[2:4])
-			pointer = 0
-			chunk_read_bytes = 0
-			chunk = 0
-			while pointer < len(self.raw):
-				chunk += 1
-				chunk_size, chunk_next = struct.unpack('<BB', self.raw[pointer:pointer+2])
-				if chunk == 1:
-					if chunk_next != 0x01:
-						raise Exception('The first chunk is bad')
-				else:
-					if chunk_next != 0xff:
-						raise Exception('Error in the chunk chain')
-				pointer += 2
-				buffer.write(self.raw[pointer:pointer+chunk_size])
-				chunk_read_bytes += chunk_size
-				pointer += chunk_size
-		self.raw = buffer.getvalue()[4:]
+		self.raw = decoder.messages.popleft()
 		self.header = False
-		buffer.close()
 		return self.raw
+
+# Incremental decoder of the chunked M2 stream framing
+# Accepts arbitrary byte chunks and collects the complete message payloads as memoryviews
+class mtStreamDecoder(object):
+	def __init__(self):
+		self.messages = deque()
+		self.reset()
+
+	# Drop a partially decoded message
+	def reset(self):
+		self.header = bytearray()
+		self.prefix = bytearray()
+		self.started = False
+		self.chunk_remaining = 0
+		self.message = None
+		self.position = 0
+
+	# Decode the given bytes, returns the number of messages completed
+	def feed(self, data):
+		view = memoryview(data)
+		pointer = 0
+		end = len(view)
+		completed = 0
+		while pointer < end:
+			# A chunk header: the chunk length and 0x01 for the first chunk or 0xff for the next ones
+			if not self.chunk_remaining:
+				take = min(2 - len(self.header), end - pointer)
+				self.header += view[pointer:pointer+take]
+				pointer += take
+				if len(self.header) < 2:
+					break
+				chunk_size, chunk_next = self.header
+				self.header = bytearray()
+				if not self.started:
+					if chunk_next != 0x01:
+						raise Exception('The first chunk is bad')
+					self.started = True
+				elif chunk_next != 0xff:
+					raise Exception('Error in the chunk chain')
+				self.chunk_remaining = chunk_size
+				continue
+			take = min(self.chunk_remaining, end - pointer)
+			# The message starts with its big endian length, followed by the M2 header
+			if self.message is None:
+				take = min(take, 2 - len(self.prefix))
+				self.prefix += view[pointer:pointer+take]
+				if len(self.prefix) == 2:
+					length, = BIG_LENGTH_STRUCT.unpack(self.prefix)
+					if length < 2:
+						raise Exception('Incorrect message length')
+					self.message = bytearray(length + 2)
+					self.message[0:2] = self.prefix
+					self.position = 2
+					self.prefix = bytearray()
+			else:
+				if take > len(self.message) - self.position:
+					raise Exception('The chunk exceeds the message length')
+				self.message[self.position:self.position+take] = view[pointer:pointer+take]
+				self.position += take
+			pointer += take
+			self.chunk_remaining -= take
+			if self.message is not None and self.position == len(self.message):
+				if self.chunk_remaining:
+					raise Exception('The chunk exceeds the message length')
+				payload = memoryview(self.message)
+				if payload[2:4] != M2_HEADER:
+					raise Exception('Not an M2 packet')
+				self.messages.append(payload[4:])
+				self.reset()
+				completed += 1
+		return completed
+
+	# Iterate over (and consume) the complete message payloads
+	def __iter__(self):
+		while self.messages:
+			yield self.messages.popleft()
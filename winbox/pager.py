@@ -0,0 +1,110 @@
+#!/usr/bin/env python3
+
+from winbox.common import *
+from winbox.message import *
+from winbox.packet import *
+
+# The objects per page by default, small enough for a page to fit a single M2 message
+PAGE_SIZE		= 256
+
+# Make a STD_FILTER message out of an mtMessage or a list of (id, type, value)
+def make_filter(filter):
+	if filter is None or isinstance(filter, mtMessage):
+		return filter
+	msg = mtMessage()
+	for id, type, value in filter:
+		msg.add(id, type, value)
+	return msg
+
+# Reads a large object table of a handler in pages of CMD_GETALL requests
+# Every page starts at a STD_GETALLID cursor and holds up to STD_GETALLNO objects, the device sets
+# STD_FINISHED on the last one (an empty page or a cursor that doesn't move end the reading too);
+# the next page is requested as soon as a page comes in, so it is on the way while the caller
+# works through the current one
+# A STD_FILTER message, if given, has the device send only the matching objects
+class mtTableReader(object):
+	def __init__(self, winbox_session, handler, subhandler = None, sender = (0x00, 0x57), page_size = PAGE_SIZE, filter = None, schema = None):
+		self.session = winbox_session.session
+		self.request_id = winbox_session.request_id
+		self.to = (handler,) if subhandler is None else (handler, subhandler)
+		self.sender = sender
+		self.page_size = page_size
+		self.filter = make_filter(filter)
+		# An mtSchema (or an mtRowDecoder) to yield compact records instead of mtMessages
+		self.schema = schema
+		self.error = None
+		self.error_description = None
+		# Pages and objects read by the last read
+		self.pages = 0
+		self.objects = 0
+
+	# Build a request for a page starting at a cursor
+	def page_request(self, cursor):
+		self.request_id = self.session.next_request_id()
+		msg = mtMessage()
+		msg.set_reply_expected(True)
+		msg.set_request_id(self.request_id)
+		msg.set_command(CMD_GETALL)
+		msg.set_to(*self.to)
+		msg.set_from(*self.sender)
+		msg.add_u32(STD_GETALLID, cursor)
+		msg.add_u32(STD_GETALLNO, self.page_size)
+		if self.filter is not None:
+			msg.add_message(STD_FILTER, self.filter)
+		return mtPacket(msg.build(), self.request_id)
+
+	# Handle a page, returns its objects (lazily parsed mtMessages or records), the next cursor
+	# and whether it is the last page
+	def page_reply(self, result, cursor):
+		self.error = result.get_value(SYS_ERRNO, U32)
+		if self.error is not None:
+			self.error_description = result.get_value(SYS_ERRSTR, STRING)
+			raise Exception('Error reading the objects of %s (error %s %s)' % (self.to, self.error, self.error_description))
+		objs = list(result.iter_messages(STD_OBJS))
+		self.pages += 1
+		self.objects += len(objs)
+		# A short page is not the end, the device may cap a page to fit a message or filter it
+		finished = bool(result.get_value(STD_FINISHED, BOOL)) or not objs
+		# The device may tell where to go on, otherwise continue past the last object
+		# (taken from the message, a schema may not declare STD_ID)
+		next_cursor = result.get_value(STD_GETALLID, U32)
+		if next_cursor is None and objs:
+			last_id = objs[-1].get_value(STD_ID, U32)
+			next_cursor = last_id + 1 if last_id is not None else None
+		if next_cursor is None or next_cursor == cursor:
+			finished = True
+		if self.schema is not None:
+			objs = self.schema.decode_all(objs)
+		return objs, next_cursor, finished
+
+	# Yield the objects of the table (lazily parsed mtMessages or records), a page at a time
+	def read(self, cursor = 0):
+		return self.session.iterate(self.read_steps(cursor))
+
+	# The steps of read() (see mtTCPSession.iterate())
+	def read_steps(self, cursor):
+		self.pages = 0
+		self.objects = 0
+		future = yield (self.session.submit, self.page_request(cursor))
+		try:
+			while future is not None:
+				objs, cursor, finished = self.page_reply((yield (self.session.wait, future)), cursor)
+				# Prefetch the next page before handing out this one
+				future = None if finished else (yield (self.session.submit, self.page_request(cursor)))
+				for obj in objs:
+					yield (None, obj)
+		finally:
+			# Collect a prefetched page the caller hasn't got to, to keep the session clean
+			if future is not None:
+				try:
+					yield (self.session.wait, future)
+				except Exception:
+					pass
+
+	def __iter__(self):
+		return self.read()
+
+# mtTableReader over an mtAsyncWinboxSession, read() gives an async iterator
+class mtAsyncTableReader(mtTableReader):
+	def __aiter__(self):
+		return self.read()
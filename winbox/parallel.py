@@ -0,0 +1,153 @@
+#!/usr/bin/env python3
+
+import itertools
+import multiprocessing
+import os
+import queue
+import threading
+from concurrent.futures import Future, ProcessPoolExecutor
+from time import monotonic
+from winbox.common import *
+from winbox.message import *
+from winbox.packet import *
+from winbox.fleet import *
+
+# Per worker process counters
+class mtWorkerStats(object):
+	def __init__(self, pid):
+		self.pid = pid
+		self.items = 0
+		self.bytes = 0
+		# Seconds spent working (summed over the threads of a shard), and since the worker has started
+		self.busy = 0.0
+		self.elapsed = 0.0
+
+	# Items and bytes per second of the process: over the wall-clock time once known, as a shard
+	# runs its targets on several threads at once, otherwise over the busy time (parse workers)
+	def throughput(self):
+		seconds = self.elapsed or self.busy
+		if not seconds:
+			return (0.0, 0.0)
+		return (self.items / seconds, self.bytes / seconds)
+
+	def __repr__(self):
+		items_rate, bytes_rate = self.throughput()
+		return 'mtWorkerStats(pid %d: %d items, %d bytes, %.1f items/s, %.0f bytes/s)' % (self.pid, self.items, self.bytes, items_rate, bytes_rate)
+
+# Parse a raw message in a worker process, framed data gets its M2 header removed first
+# Returns the pid, the parsed contents, the seconds spent and the raw size
+def parse_worker(raw, framed = False):
+	started = monotonic()
+	if framed:
+		pkt = mtPacket(raw)
+		raw = pkt.remove_header()
+	msg = mtMessage(raw)
+	msg.parse()
+	return os.getpid(), msg.contents, monotonic() - started, len(raw)
+
+# Parses raw replies in a pool of processes, so large tables don't saturate a single core
+# The contents come back in the usual (id, type, value) form with fixed size arrays as array.array
+class mtParsePool(object):
+	def __init__(self, processes = None):
+		self.executor = ProcessPoolExecutor(processes)
+		self.lock = threading.Lock()
+		self.stats = {}
+
+	# Account for a finished parse and unwrap its contents
+	def collect(self, outcome):
+		pid, contents, busy, size = outcome
+		with self.lock:
+			stats = self.stats.get(pid)
+			if stats is None:
+				stats = self.stats[pid] = mtWorkerStats(pid)
+			stats.items += 1
+			stats.bytes += size
+			stats.busy += busy
+		return contents
+
+	# Parse a raw message (or a framed packet), returns a future of its contents
+	def parse(self, raw, framed = False):
+		future = self.executor.submit(parse_worker, bytes(raw), framed)
+		result = Future()
+		def done(future):
+			try:
+				result.set_result(self.collect(future.result()))
+			except Exception as e:
+				result.set_exception(e)
+		future.add_done_callback(done)
+		return result
+
+	# Parse many raw messages, yielding their contents in order
+	def map(self, raws, framed = False, chunksize = 16):
+		outcomes = self.executor.map(parse_worker, (bytes(raw) for raw in raws), itertools.repeat(framed), chunksize = chunksize)
+		for outcome in outcomes:
+			yield self.collect(outcome)
+
+	def close(self):
+		self.executor.shutdown()
+
+# Run an mtFleet over the targets read from a queue, sending the results and the final stats back
+def shard_worker(inputs, outputs, operation, workers, timeout):
+	stats = mtWorkerStats(os.getpid())
+	started = monotonic()
+	def targets():
+		while True:
+			target = inputs.get()
+			if target is None:
+				return
+			yield target
+	fleet = mtFleet(workers, timeout)
+	for result in fleet.run(targets(), operation):
+		result.worker = stats.pid
+		stats.items += 1
+		stats.busy += result.elapsed
+		outputs.put(result)
+	stats.elapsed = monotonic() - started
+	outputs.put(stats)
+
+# Shards a fleet across worker processes, each one running its own mtFleet of threads
+# The operation has to be picklable (a module level function) and so do its results
+class mtShardedFleet(object):
+	def __init__(self, processes = None, workers = 32, timeout = None):
+		self.processes = processes or os.cpu_count() or 1
+		self.workers = workers
+		self.timeout = timeout
+		self.stats = {}
+
+	# Run the operation on every target, yielding the results as they complete
+	# The per worker stats are in self.stats once the run is over
+	def run(self, targets, operation):
+		context = multiprocessing.get_context()
+		inputs = context.Queue(self.processes * self.workers * 2)
+		outputs = context.Queue()
+		processes = [context.Process(target = shard_worker, args = (inputs, outputs, operation, self.workers, self.timeout), daemon = True) for i in range(self.processes)]
+		for process in processes:
+			process.start()
+		# Feed the targets lazily, followed by a stop mark for every process
+		def feed():
+			for target in targets:
+				inputs.put(make_target(target))
+			for process in processes:
+				inputs.put(None)
+		feeder = threading.Thread(target = feed, daemon = True)
+		feeder.start()
+		self.stats = {}
+		try:
+			running = len(processes)
+			while running:
+				try:
+					result = outputs.get(timeout = 1)
+				except queue.Empty:
+					if not any(process.is_alive() for process in processes):
+						raise Exception('Worker processes have exited unexpectedly')
+					continue
+				if isinstance(result, mtWorkerStats):
+					self.stats[result.pid] = result
+					running -= 1
+				else:
+					yield result
+		finally:
+			for process in processes:
+				if process.is_alive():
+					process.terminate()
+				process.join()
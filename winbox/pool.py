@@ -0,0 +1,176 @@
+#!/usr/bin/env python3
+
+import threading
+from contextlib import contextmanager
+from time import monotonic
+from winbox.common import *
+from winbox.session import *
+
+# A thread-safe pool of logged in winbox sessions, keyed by host, port and credentials
+# Sessions without credentials (user is None) are connected but not logged in, e.g. for mtAgent
+class mtSessionPool(object):
+	def __init__(self, max_per_host = 4, idle_timeout = 300, timeout = None):
+		self.max_per_host = max_per_host
+		self.idle_timeout = idle_timeout
+		self.timeout = timeout
+		self.condition = threading.Condition()
+		# key -> [(session, released at)], the most recently released last
+		self.idle = {}
+		# host -> number of sessions, both idle and checked out
+		self.counts = {}
+		self.closed = False
+
+	# Connect (and log in) a new session for a given key
+	def open(self, key):
+		host, port, user, password = key
+		session = mtWinboxSession(host, port, timeout = self.timeout)
+		if user is not None:
+			try:
+				logged_in = session.login_fast(user, password)[0] is not None
+			except:
+				session.close()
+				raise
+			if not logged_in:
+				session.close()
+				raise Exception('Login failed to %s:%s (error %s)' % (host, port, session.error))
+		session.pool_key = key
+		return session
+
+	# Close the sessions idle for longer than idle_timeout, the condition lock has to be held
+	def evict_idle(self):
+		deadline = monotonic() - self.idle_timeout
+		for key, idle in list(self.idle.items()):
+			while idle and idle[0][1] < deadline:
+				session, released = idle.pop(0)
+				self.forget(session)
+				session.close()
+			if not idle:
+				del self.idle[key]
+
+	# Close the oldest idle session of a given host, the condition lock has to be held
+	def evict_host(self, host):
+		oldest = None
+		for key, idle in self.idle.items():
+			if key[0] == host and idle and (oldest is None or idle[0][1] < self.idle[oldest][0][1]):
+				oldest = key
+		if oldest is None:
+			return
+		session, released = self.idle[oldest].pop(0)
+		if not self.idle[oldest]:
+			del self.idle[oldest]
+		self.forget(session)
+		session.close()
+
+	# Drop a session from the host counters, the condition lock has to be held
+	def forget(self, session):
+		host = session.pool_key[0]
+		self.counts[host] -= 1
+		if not self.counts[host]:
+			del self.counts[host]
+		self.condition.notify_all()
+
+	# Get a session, reusing an idle one if it is still alive
+	# Waits up to wait seconds (forever if None) when the host has max_per_host sessions out
+	def checkout(self, host, port = None, user = None, password = None, wait = None):
+		key = (host, port or 8291, user, password)
+		deadline = None if wait is None else monotonic() + wait
+		with self.condition:
+			while True:
+				if self.closed:
+					raise Exception('The pool is closed')
+				self.evict_idle()
+				idle = self.idle.get(key)
+				if idle:
+					session, released = idle.pop()
+					break
+				# Make room by closing an idle session of the same host with other credentials
+				if self.counts.get(host, 0) >= self.max_per_host:
+					self.evict_host(host)
+				if self.counts.get(host, 0) < self.max_per_host:
+					self.counts[host] = self.counts.get(host, 0) + 1
+					session = None
+					break
+				remaining = None if deadline is None else deadline - monotonic()
+				if remaining is not None and remaining <= 0:
+					raise Exception('No free session for %s within %s seconds' % (host, wait))
+				self.condition.wait(remaining)
+		# The slot is ours now, connect or check the session outside of the lock
+		try:
+			if session is not None:
+				if session.session.is_alive():
+					return session
+				session.close()
+			return self.open(key)
+		except:
+			with self.condition:
+				self.counts[host] -= 1
+				if not self.counts[host]:
+					del self.counts[host]
+				self.condition.notify_all()
+			raise
+
+	# Return a session to the pool, dead sessions are dropped
+	def release(self, session):
+		with self.condition:
+			if self.closed or not session.session.is_alive():
+				self.forget(session)
+				session.close()
+				return
+			session.session.unsolicited.clear()
+			# Subscriptions don't outlive a checkout
+			session.session.listeners = []
+			session.session.fallback_listeners = []
+			session.subscriptions = []
+			self.idle.setdefault(session.pool_key, []).append((session, monotonic()))
+			self.condition.notify_all()
+
+	# Check the idle sessions, reconnecting the dead ones, so the next checkouts get warm sessions
+	# Sessions that have received something within idle seconds are not pinged
+	def warm(self, idle = 0):
+		with self.condition:
+			checking = [(key, entry) for key, entries in self.idle.items() for entry in entries]
+			self.idle = {}
+		alive = []
+		for key, (session, released) in checking:
+			if session.ensure_alive(idle):
+				alive.append((key, (session, released)))
+			else:
+				self.discard(session)
+		with self.condition:
+			for key, entry in alive:
+				if self.closed:
+					self.forget(entry[0])
+					entry[0].close()
+				else:
+					self.idle.setdefault(key, []).append(entry)
+			for entries in self.idle.values():
+				entries.sort(key = lambda entry: entry[1])
+			self.condition.notify_all()
+		return len(alive)
+
+	# Close and drop a session that should not be reused
+	def discard(self, session):
+		with self.condition:
+			self.forget(session)
+		session.close()
+
+	# Borrow a session for a with block, it is discarded if the block raises an exception
+	@contextmanager
+	def borrow(self, host, port = None, user = None, password = None, wait = None):
+		session = self.checkout(host, port, user, password, wait)
+		try:
+			yield session
+		except:
+			self.discard(session)
+			raise
+		self.release(session)
+
+	# Close all the idle sessions and refuse the further checkouts
+	def close(self):
+		with self.condition:
+			self.closed = True
+			for idle in self.idle.values():
+				for session, released in idle:
+					self.forget(session)
+					session.close()
+			self.idle = {}
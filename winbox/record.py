@@ -0,0 +1,178 @@
+#!/usr/bin/env python3
+
+import sys
+from winbox.common import *
+from winbox.message import *
+
+# Shares equal values between the decoded objects, e.g. the same interface names across a snapshot
+# It holds every value it has seen, so it lives as long as a snapshot (see mtSchema.decode_all())
+# rather than the process; only the STRING fields are interned, never the unique RAW blobs
+class mtInterner(object):
+	def __init__(self):
+		self.values = {}
+
+	def intern(self, value):
+		if isinstance(value, (bytes, str)):
+			return self.values.setdefault(value, value)
+		return value
+
+	def __len__(self):
+		return len(self.values)
+
+# A value copied out of the reply it was parsed from, a STRING is interned if there is an interner
+def decode_value(type, value, interner):
+	if isinstance(value, memoryview):
+		value = bytes(value)
+	if type == STRING and interner is not None:
+		return interner.intern(value)
+	return value
+
+# The (id, type, value) sequence of an mtMessage or of a contents list
+def message_items(msg):
+	if isinstance(msg, mtMessage):
+		return msg.items()
+	return msg
+
+# A generic compact object: the (id, type) layout is a tuple shared by all the rows alike,
+# the values are a tuple of their own
+class mtRow(object):
+	__slots__ = ('keys', 'values')
+
+	def __init__(self, keys, values):
+		self.keys = keys
+		self.values = values
+
+	def get(self, id, type, default = None):
+		try:
+			return self.values[self.keys.index((id, type))]
+		except ValueError:
+			return default
+
+	def __getitem__(self, key):
+		return self.values[self.keys.index(key)]
+
+	def __contains__(self, key):
+		return key in self.keys
+
+	def __len__(self):
+		return len(self.values)
+
+	# The usual (id, type, value) form
+	def items(self):
+		return [(id, type, value) for (id, type), value in zip(self.keys, self.values)]
+
+	def __eq__(self, other):
+		return isinstance(other, mtRow) and self.keys == other.keys and self.values == other.values
+
+	def __repr__(self):
+		return 'mtRow(%r)' % (self.items(),)
+
+# Decodes messages into mtRows, sharing the layouts, and the STRING values through an interner
+# An interner given here is used for every decode, otherwise decode_all() uses one per snapshot
+class mtRowDecoder(object):
+	def __init__(self, interner = None):
+		self.interner = interner
+		self.layouts = {}
+
+	def decode(self, msg, interner = None):
+		if interner is None:
+			interner = self.interner
+		keys = []
+		values = []
+		for id, type, value in message_items(msg):
+			keys.append((id, type))
+			if type == MESSAGE:
+				value = self.decode(value, interner)
+			elif type == MESSAGE_ARRAY:
+				value = tuple(self.decode(element, interner) for element in value)
+			else:
+				value = decode_value(type, value, interner)
+			values.append(value)
+		keys = tuple(keys)
+		return mtRow(self.layouts.setdefault(keys, keys), tuple(values))
+
+	# Decode a snapshot of objects, the STRING values shared among them
+	def decode_all(self, msgs):
+		interner = self.interner if self.interner is not None else mtInterner()
+		return [self.decode(msg, interner) for msg in msgs]
+
+# The base of the record classes made by mtSchema
+class mtRecord(object):
+	__slots__ = ()
+
+	def as_dict(self):
+		return {attribute: getattr(self, attribute) for attribute in self.__slots__}
+
+	def __eq__(self, other):
+		return type(other) is type(self) and all(getattr(self, attribute) == getattr(other, attribute) for attribute in self.__slots__)
+
+	def __repr__(self):
+		return '%s(%s)' % (type(self).__name__, ', '.join('%s=%r' % (attribute, getattr(self, attribute)) for attribute in self.__slots__))
+
+# A user declared mapping of field ids to named attributes, decoding messages into __slots__ records
+# fields maps an attribute name to (id, type), or to (id, type, schema) for a MESSAGE or a
+# MESSAGE_ARRAY decoded with a nested schema; the fields not declared are dropped unless
+# keep_extra is set, then they are kept in the 'extra' attribute in the usual (id, type, value) form
+# The STRING fields are interned as with mtRowDecoder
+class mtSchema(object):
+	def __init__(self, name, fields, keep_extra = False, interner = None):
+		self.name = name
+		self.keep_extra = keep_extra
+		self.interner = interner
+		self.attributes = []
+		self.positions = {}
+		self.nested = {}
+		for attribute, field in dict(fields).items():
+			key = (field[0], field[1])
+			self.positions[key] = len(self.attributes)
+			self.attributes.append(sys.intern(attribute))
+			if len(field) > 2:
+				self.nested[key] = field[2]
+		slots = tuple(self.attributes) + (('extra',) if keep_extra else ())
+		self.record_class = type(name, (mtRecord,), {'__slots__': slots})
+
+	# Decode an mtMessage (or a contents list) into a record, the missing fields are None
+	def decode(self, msg, interner = None):
+		if interner is None:
+			interner = self.interner
+		values = [None] * len(self.attributes)
+		extra = []
+		for id, type, value in message_items(msg):
+			position = self.positions.get((id, type))
+			if position is None:
+				if self.keep_extra:
+					extra.append((id, type, decode_value(type, value, None)))
+				continue
+			schema = self.nested.get((id, type))
+			if schema is not None:
+				if type == MESSAGE_ARRAY:
+					value = tuple(schema.decode(element, interner) for element in value)
+				else:
+					value = schema.decode(value, interner)
+			else:
+				value = decode_value(type, value, interner)
+			values[position] = value
+		record = self.record_class.__new__(self.record_class)
+		for attribute, value in zip(self.attributes, values):
+			setattr(record, attribute, value)
+		if self.keep_extra:
+			record.extra = tuple(extra)
+		return record
+
+	# Get a field of a record by its id and type, None if the schema doesn't declare it
+	def get(self, record, id, type):
+		position = self.positions.get((id, type))
+		if position is None:
+			return None
+		return getattr(record, self.attributes[position])
+
+	# Decode a snapshot of objects, the STRING values shared among them
+	def decode_all(self, msgs):
+		interner = self.interner if self.interner is not None else mtInterner()
+		return [self.decode(msg, interner) for msg in msgs]
+
+	# Decode the elements of a MESSAGE_ARRAY of a message one at a time (see mtMessage.iter_messages())
+	def iter_records(self, msg, id = STD_OBJS):
+		interner = self.interner if self.interner is not None else mtInterner()
+		for element in msg.iter_messages(id):
+			yield self.decode(element, interner)
@@ -2,6 +2,15 @@
 
 from winbox.common import *
 from winbox.session import *
+from winbox.record import *
+
+# The service fields as record attributes, see mtServices.records()
+SERVICE_SCHEMA = mtSchema('mtServiceRecord', {
+	'id':		(STD_ID, U32),
+	'name':		(1, STRING),
+	'port':		(2, U32),
+	'disabled':	(STD_DISABLED, BOOL),
+})
 
 class mtServices(object):
 	def __init__(self, winbox_session):
@@ -11,74 +20,126 @@ class mtServices(object):
 		self.error = None
 		self.error_description = None
 		self.services = None
+		# Indexes built by get_all(): name -> service id and service id -> service
+		self.ids = {}
+		self.by_id = {}
 
-	def get_all(self):
-		self.request_id += 1
+	# Build a request for all the services
+	def get_all_request(self):
+		self.request_id = self.session.next_request_id()
 		msg = mtMessage()
 		msg.set_reply_expected(True)
 		msg.set_request_id(self.request_id)
 		msg.set_command(CMD_GETALL)
 		msg.set_to(0x44, 0x01)
 		msg.set_from(0x00, 0x57)
-		pkt = mtPacket(msg.build())
-		self.session.send(pkt)
-		reply = self.session.recv(1000)
-		result = mtMessage(reply.raw)
-		result.parse()
+		return mtPacket(msg.build(), self.request_id)
+
+	def get_all_reply(self, result):
 		self.services = result.get_value(STD_OBJS, MESSAGE_ARRAY)
+		self.index()
 
-	def set_port(self, id, port):
-		self.request_id += 1
+	# Index the services by name and by id
+	def index(self):
+		self.ids = {}
+		self.by_id = {}
+		for s in self.services or ():
+			service_id = None
+			service_name = None
+			for id, type, value in s:
+				if id == STD_ID and type == U32:
+					service_id = value
+				elif id == 1 and type == STRING:
+					service_name = value
+			if service_id is None:
+				continue
+			self.by_id.setdefault(service_id, s)
+			if service_name is not None:
+				self.ids.setdefault(service_name, service_id)
+
+	def get_all(self):
+		self.get_all_reply(self.session.request(self.get_all_request()))
+
+	# Build a request changing a service object
+	def set_request(self, id, type, param_id, value):
+		return self.set_fields_request(id, ((param_id, type, value),))
+
+	# Build a request changing several (param_id, type, value) fields of a service object at once
+	def set_fields_request(self, id, fields):
+		self.request_id = self.session.next_request_id()
 		msg = mtMessage()
 		msg.set_reply_expected(True)
 		msg.set_request_id(self.request_id)
 		msg.set_command(CMD_SETOBJ)
 		msg.set_to(0x44, 0x01)
 		msg.set_from(0x00, 0x57)
-		msg.add_u32(2, port)
+		for param_id, type, value in fields:
+			msg.add(param_id, type, value)
 		msg.add_u32(STD_ID, id)
-		pkt = mtPacket(msg.build())
-		self.session.send(pkt)
-		reply = self.session.recv(1000)
-		result = mtMessage(reply.raw)
-		result.parse()
+		return mtPacket(msg.build(), self.request_id)
+
+	# Build the requests of a bulk update, see update(), None for a change with nothing to set
+	def update_requests(self, changes):
+		requests = []
+		for service, port, disabled in changes:
+			service_id = self.resolve(service)
+			fields = []
+			if port is not None:
+				fields.append((2, U32, port))
+			if disabled is not None:
+				fields.append((STD_DISABLED, BOOL, disabled))
+			requests.append(self.set_fields_request(service_id, fields) if fields else None)
+		return requests
+
+	# Apply many changes in a single pipelined burst, a change is (service, port, disabled) with
+	# the service given by its name or id and None leaving a field as it is
+	# Returns one reply per change, in the order of the changes (None for those with nothing to set,
+	# they aren't sent), check them with update_errors()
+	def update(self, changes):
+		requests = self.update_requests(changes)
+		futures = [None if pkt is None else self.session.submit(pkt, flush = False) for pkt in requests]
+		if not self.session.flush():
+			raise Exception('Send error to %s:%s' % (self.session.host, self.session.port))
+		return [None if future is None else self.session.wait(future) for future in futures]
+
+	# The (index, SYS_ERRNO, SYS_ERRSTR) of the failed replies of an update(), index is the one
+	# of the change
+	def update_errors(self, replies):
+		errors = []
+		for index, result in enumerate(replies):
+			if result is None:
+				continue
+			error = result.get_value(SYS_ERRNO, U32)
+			if error is not None:
+				errors.append((index, error, result.get_value(SYS_ERRSTR, STRING)))
+		return errors
+
+	# Get a service id out of a name or an id
+	def resolve(self, service):
+		if isinstance(service, int):
+			return service
+		if isinstance(service, str):
+			service = service.encode()
+		service_id = self.ids.get(service)
+		if service_id is None:
+			raise Exception('Unknown service %r' % service)
+		return service_id
+
+	def set_port(self, id, port):
+		return self.session.request(self.set_request(id, U32, 2, port))
 
 	def set_disabled(self, id, disabled):
-		self.request_id += 1
-		msg = mtMessage()
-		msg.set_reply_expected(True)
-		msg.set_request_id(self.request_id)
-		msg.set_command(CMD_SETOBJ)
-		msg.set_to(0x44, 0x01)
-		msg.set_from(0x00, 0x57)
-		msg.add_bool(STD_DISABLED, disabled)
-		msg.add_u32(STD_ID, id)
-		pkt = mtPacket(msg.build())
-		self.session.send(pkt)
-		reply = self.session.recv(1000)
-		result = mtMessage(reply.raw)
-		result.parse()
+		return self.session.request(self.set_request(id, BOOL, STD_DISABLED, disabled))
 
 	def get_id(self, name):
-		for s in self.services:
-			service_id = None
-			service_name = None
-			for id, type, value in s:
-				if id == STD_ID and type == U32:
-					service_id = value
-				if id == 1 and type == STRING:
-					service_name = value
-			if service_name == name:
-				return service_id
-		return None
+		return self.ids.get(name)
 
 	def get_data(self, service_id):
-		for s in self.services:
-			for id, type, value in s:
-				if id == STD_ID and type == U32:
-					if value == service_id:
-						return s
-		return None
+		return self.by_id.get(service_id)
+
+	# The services of the last get_all() as compact records with named attributes
+	def records(self, schema = SERVICE_SCHEMA):
+		return schema.decode_all(self.services or ())
 
 	def get_value(self, service, param_id, param_type):
 		for id, type, value in service:
@@ -86,3 +147,19 @@ class mtServices(object):
 				return value
 		return None
 
+# mtServices over an mtAsyncWinboxSession
+class mtAsyncServices(mtServices):
+	async def get_all(self):
+		self.get_all_reply(await self.session.request(self.get_all_request()))
+
+	async def set_port(self, id, port):
+		return await self.session.request(self.set_request(id, U32, 2, port))
+
+	async def set_disabled(self, id, disabled):
+		return await self.session.request(self.set_request(id, BOOL, STD_DISABLED, disabled))
+
+	async def update(self, changes):
+		requests = self.update_requests(changes)
+		futures = [None if pkt is None else await self.session.submit(pkt, flush = False) for pkt in requests]
+		await self.session.flush()
+		return [None if future is None else await self.session.wait(future) for future in futures]
@@ -1,7 +1,7 @@
 #!/usr/bin/env python3
 
 import hashlib
-from time import sleep
+from time import monotonic
 from winbox.common import *
 from winbox.message import *
 from winbox.packet import *
@@ -19,14 +19,31 @@ class mtWinboxSession(object):
 		self.session_id = None
 		self.request_id = 0
 		self.error = None
+		# (user, password, cleartext) of the last successful login, to log in again after a reconnect
+		self.credentials = None
+		# The mtSubscriptions to renew after a reconnect
+		self.subscriptions = []
 
 	# Close a session
 	def close(self):
 		self.session.close()
 		self.session_id = None
 
-	def request_list(self):
-		self.request_id += 1
+	# Send a request without waiting for its reply, several requests can be outstanding at once
+	# The request id and the reply expected flag are set here, returns a future for wait()
+	def submit(self, msg):
+		self.request_id = self.session.next_request_id()
+		msg.set_request_id(self.request_id)
+		msg.set_reply_expected(True)
+		return self.session.submit(mtPacket(msg.build(), self.request_id))
+
+	# Wait for a reply to a submitted request
+	def wait(self, future):
+		return self.session.wait(future)
+
+	# Build a request for the 'list' file, which opens a session
+	def list_request(self):
+		self.request_id = self.session.next_request_id()
 		msg = mtMessage()
 		msg.set_to(2, 2)
 		msg.set_from(0, 11)
@@ -34,14 +51,10 @@ class mtWinboxSession(object):
 		msg.set_request_id(self.request_id)
 		msg.set_reply_expected(True)
 		msg.add_string(1, b'list')
-		pkt = mtPacket(msg.build())
-
-		self.session.send(pkt)
-		sleep(0.2)
-		reply = self.session.recv(1460)
-		result = mtMessage(reply.raw)
-		result.parse()
+		return mtPacket(msg.build(), self.request_id)
 
+	# Handle a reply for the 'list' request
+	def list_reply(self, result):
 		error = result.get_value(SYS_ERRNO, U32)
 		if error is not None:
 			self.error = error
@@ -55,48 +68,54 @@ class mtWinboxSession(object):
 			raise Exception('Got no session id')
 		return False
 
-	# Request a challenge
-	def request_challenge(self):
+	def request_list(self):
+		return self.list_reply(self.session.request(self.list_request()))
+
+	# Build a request closing the 'list' session, it gets no reply
+	def close_list_request(self):
 		if self.session_id is None:
 			raise Exception('No session')
-
-		self.request_id += 1
-
 		msg = mtMessage()
 		msg.set_session_id(self.session_id)
 		msg.set_command(5)
 		msg.set_from(0, 11)
 		msg.set_to(2, 2)
-		pkt1 = mtPacket(msg.build())
-		self.session.send(pkt1)
+		return mtPacket(msg.build())
 
-		msg.clear()
+	# Build a challenge (salt) request, it doesn't depend on the 'list' session
+	def challenge_request(self):
+		self.request_id = self.session.next_request_id()
+		msg = mtMessage()
 		msg.set_reply_expected(True)
 		msg.set_request_id(self.request_id)
 		msg.set_command(4)
 		msg.set_from(0, 11)
 		msg.set_to(13, 4)
-		pkt2 = mtPacket(msg.build())
-		self.session.send(pkt2)
+		return mtPacket(msg.build(), self.request_id)
+
+	# Build the challenge requests: the first one is sent without a reply expected
+	def challenge_requests(self):
+		return self.close_list_request(), self.challenge_request()
 
-		reply = self.session.recv(1460)
-		result = mtMessage(reply.raw)
-		result.parse()
+	# Handle a reply with a challenge (salt)
+	def challenge_reply(self, result):
 		return result.get_value(9, RAW)
 
-	# MD5 challenge/response authentication
-	def login(self, user, password):
-		if self.session_id is not None:
-			raise Exception('Already logged in')
-		self.request_list()
-		salt = self.request_challenge()
+	# Request a challenge
+	def request_challenge(self):
+		pkt1, pkt2 = self.challenge_requests()
+		self.session.queue(pkt1)
+		return self.challenge_reply(self.session.request(pkt2))
+
+	# Build a login request, hashing the password with a given salt
+	def login_request(self, user, password, salt):
 		digest = hashlib.md5()
 		digest.update(b'\x00')
 		digest.update(password)
 		digest.update(salt)
 		hashed = b'\x00' + digest.digest()
 
-		self.request_id += 1
+		self.request_id = self.session.next_request_id()
 		msg = mtMessage()
 		msg.set_to(13, 4)
 		msg.set_from(0, 8)
@@ -107,23 +126,66 @@ class mtWinboxSession(object):
 		msg.add_string(1, user)
 		msg.add_raw(9, salt)
 		msg.add_raw(10, hashed)
-		pkt = mtPacket(msg.build())
-		self.session.send(pkt)
-		reply = self.session.recv(1460)
-		result = mtMessage(reply.raw)
-		result.parse()
+		return mtPacket(msg.build(), self.request_id)
 
+	# Handle a login reply
+	def login_reply(self, result):
 		error = result.get_value(SYS_ERRNO, U32)
 		if error is not None:
 			self.error = error
 			return False
 		return True
 
-	# Dude-style cleartext login to a winbox server
-	def login_cleartext(self, user, password):
+	# MD5 challenge/response authentication
+	def login(self, user, password):
 		if self.session_id is not None:
 			raise Exception('Already logged in')
-		self.request_id += 1
+		self.request_list()
+		salt = self.request_challenge()
+		return self.logged_in(self.login_reply(self.session.request(self.login_request(user, password, salt))), user, password)
+
+	# Remember the credentials of a successful login
+	def logged_in(self, success, user, password, cleartext = False):
+		if success:
+			self.credentials = (user, password, cleartext)
+		return success
+
+	# Handle the replies to the pipelined 'list' and challenge requests, returns the salt or None
+	def login_fast_replies(self, list_result, challenge_result):
+		if not self.list_reply(list_result):
+			return None
+		return self.challenge_reply(challenge_result)
+
+	# MD5 challenge/response authentication in two round trips: the 'list' and challenge
+	# requests go out together, then the 'list' session close along with the login request
+	# Returns the session id (None if the login has failed) and the seconds spent in each phase
+	def login_fast(self, user, password):
+		return self.session.run(self.login_fast_steps(user, password))
+
+	# The steps of login_fast() (see mtTCPSession.run())
+	def login_fast_steps(self, user, password):
+		if self.session_id is not None:
+			raise Exception('Already logged in')
+		started = monotonic()
+		list_future = yield (self.session.submit, self.list_request(), False)
+		challenge_future = yield (self.session.submit, self.challenge_request())
+		salt = self.login_fast_replies((yield (self.session.wait, list_future)), (yield (self.session.wait, challenge_future)))
+		challenged = monotonic()
+		timings = {'challenge': challenged - started}
+		logged_in = False
+		if salt is not None:
+			self.session.queue(self.close_list_request())
+			logged_in = self.logged_in(self.login_reply((yield (self.session.request, self.login_request(user, password, salt)))), user, password)
+		finished = monotonic()
+		timings['login'] = finished - challenged
+		timings['total'] = finished - started
+		return (self.session_id if logged_in else None), timings
+
+	# Build a Dude-style cleartext login request
+	def login_cleartext_request(self, user, password):
+		if self.session_id is not None:
+			raise Exception('Already logged in')
+		self.request_id = self.session.next_request_id()
 		msg = mtMessage()
 		msg.set_to(13, 4)
 		msg.set_from(0, 8)
@@ -133,13 +195,10 @@ class mtWinboxSession(object):
 		msg.set_command(1)
 		msg.add_string(1, user)
 		msg.add_string(3, password)
-		pkt = mtPacket(msg.build())
-
-		self.session.send(pkt)
-		reply = self.session.recv(1460)
-		result = mtMessage(reply.raw)
-		result.parse()
+		return mtPacket(msg.build(), self.request_id)
 
+	# Handle a cleartext login reply
+	def login_cleartext_reply(self, result):
 		error = result.get_value(SYS_ERRNO, U32)
 		if error is not None:
 			self.error = error
@@ -150,3 +209,145 @@ class mtWinboxSession(object):
 			self.session_id = session_id
 			return True
 		return False
+
+	# Dude-style cleartext login to a winbox server
+	def login_cleartext(self, user, password):
+		return self.logged_in(self.login_cleartext_reply(self.session.request(self.login_cleartext_request(user, password))), user, password, True)
+
+	# A cheap request with no side effects (a challenge) to check the session, returns the round trip time
+	def ping(self):
+		started = monotonic()
+		self.session.request(self.challenge_request())
+		return monotonic() - started
+
+	# Connect again, log in with the credentials of the last login and renew the subscriptions
+	# (the device drops them along with the connection), returns False if the login fails
+	def reconnect(self):
+		return self.session.run(self.reconnect_steps())
+
+	# The steps of reconnect() (see mtTCPSession.run())
+	def reconnect_steps(self):
+		try:
+			yield (self.session.reconnect,)
+			self.session_id = None
+			logged_in = True
+			if self.credentials is not None:
+				user, password, cleartext = self.credentials
+				if cleartext:
+					logged_in = yield (self.login_cleartext, user, password)
+				else:
+					logged_in = (yield (self.login_fast, user, password))[0] is not None
+		except Exception as e:
+			self.fail_subscriptions(e)
+			raise
+		if not logged_in:
+			self.fail_subscriptions(Exception('Login failed after a reconnect'))
+			return False
+		for subscription in list(self.subscriptions):
+			yield (subscription.resubscribe,)
+		return True
+
+	# Fail the subscriptions that can't be renewed, their iterators raise the error
+	def fail_subscriptions(self, error):
+		for subscription in list(self.subscriptions):
+			subscription.fail(error)
+
+	# Check the connection, with a ping unless it has received something within idle seconds,
+	# and reconnect a dead one, returns False if it can't be brought back
+	def ensure_alive(self, idle = 0):
+		try:
+			if self.session.is_alive():
+				if monotonic() - self.session.last_activity < idle:
+					return True
+				self.ping()
+				return True
+		except Exception:
+			pass
+		try:
+			return self.reconnect()
+		except Exception:
+			return False
+
+# Winbox session over asyncio, connect() has to be awaited before use
+class mtAsyncWinboxSession(mtWinboxSession):
+	def __init__(self, host, port, timeout = None):
+		if timeout is not None:
+			self.timeout = timeout
+		else:
+			self.timeout = 5
+		self.session = mtAsyncTCPSession(host, port, timeout = self.timeout)
+		self.session_id = None
+		self.request_id = 0
+		self.error = None
+		self.credentials = None
+		self.subscriptions = []
+
+	async def connect(self):
+		await self.session.connect()
+
+	# Close a session
+	async def close(self):
+		await self.session.close()
+		self.session_id = None
+
+	async def __aenter__(self):
+		await self.connect()
+		return self
+
+	async def __aexit__(self, *exc_info):
+		await self.close()
+
+	async def submit(self, msg):
+		self.request_id = self.session.next_request_id()
+		msg.set_request_id(self.request_id)
+		msg.set_reply_expected(True)
+		return await self.session.submit(mtPacket(msg.build(), self.request_id))
+
+	async def wait(self, future):
+		return await self.session.wait(future)
+
+	async def request_list(self):
+		return self.list_reply(await self.session.request(self.list_request()))
+
+	# Request a challenge
+	async def request_challenge(self):
+		pkt1, pkt2 = self.challenge_requests()
+		self.session.queue(pkt1)
+		return self.challenge_reply(await self.session.request(pkt2))
+
+	# MD5 challenge/response authentication
+	async def login(self, user, password):
+		if self.session_id is not None:
+			raise Exception('Already logged in')
+		await self.request_list()
+		salt = await self.request_challenge()
+		return self.logged_in(self.login_reply(await self.session.request(self.login_request(user, password, salt))), user, password)
+
+	async def login_fast(self, user, password):
+		return await self.session.run(self.login_fast_steps(user, password))
+
+	# Dude-style cleartext login to a winbox server
+	async def login_cleartext(self, user, password):
+		return self.logged_in(self.login_cleartext_reply(await self.session.request(self.login_cleartext_request(user, password))), user, password, True)
+
+	async def ping(self):
+		started = monotonic()
+		await self.session.request(self.challenge_request())
+		return monotonic() - started
+
+	async def reconnect(self):
+		return await self.session.run(self.reconnect_steps())
+
+	async def ensure_alive(self, idle = 0):
+		try:
+			if self.session.is_alive():
+				if monotonic() - self.session.last_activity < idle:
+					return True
+				await self.ping()
+				return True
+		except Exception:
+			pass
+		try:
+			return await self.reconnect()
+		except Exception:
+			return False
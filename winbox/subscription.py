@@ -0,0 +1,199 @@
+#!/usr/bin/env python3
+
+import asyncio
+import socket as socket_module
+from collections import deque
+from winbox.common import *
+from winbox.message import *
+from winbox.packet import *
+
+# Subscribes to the notifications of a handler (e.g. (0x44, 0x01) for the services)
+# The notifications are CMD_NOTIFY messages pushed by the handler, they are taken out of the
+# unsolicited messages of the session, so requests can go on along with the subscription
+# The session subscribes again after a reconnect, a subscription that can't be renewed fails and
+# its iterator raises
+class mtSubscription(object):
+	def __init__(self, winbox_session, handler, subhandler = None, sender = (0x00, 0x57)):
+		self.winbox_session = winbox_session
+		self.session = winbox_session.session
+		self.request_id = winbox_session.request_id
+		self.to = [handler] if subhandler is None else [handler, subhandler]
+		self.sender = sender
+		self.notifications = deque()
+		self.subscribed = False
+		# The error a failed subscription raises
+		self.failure = None
+		self.error = None
+		self.error_description = None
+
+	# Build a subscription request
+	def subscribe_request(self):
+		self.request_id = self.session.next_request_id()
+		msg = mtMessage()
+		msg.set_reply_expected(True)
+		msg.set_request_id(self.request_id)
+		msg.set_command(CMD_SUBSCRIBE)
+		msg.set_to(*self.to)
+		msg.set_from(*self.sender)
+		return mtPacket(msg.build(), self.request_id)
+
+	# Take the notifications and have the session renew the subscription after a reconnect,
+	# done before the request so no notification is lost
+	def register(self):
+		self.session.remove_listener(self.discard)
+		self.session.remove_listener(self.listener)
+		self.session.add_listener(self.listener)
+		if self not in self.winbox_session.subscriptions:
+			self.winbox_session.subscriptions.append(self)
+
+	def unregister(self):
+		self.session.remove_listener(self.discard)
+		self.session.remove_listener(self.listener)
+		if self in self.winbox_session.subscriptions:
+			self.winbox_session.subscriptions.remove(self)
+
+	# Handle a subscription reply
+	def subscribe_reply(self, result):
+		self.error = result.get_value(SYS_ERRNO, U32)
+		if self.error is not None:
+			self.error_description = result.get_value(SYS_ERRSTR, STRING)
+			self.unregister()
+			return False
+		self.subscribed = True
+		self.failure = None
+		return True
+
+	def subscribe(self):
+		self.register()
+		return self.subscribe_reply(self.session.request(self.subscribe_request()))
+
+	# Subscribe again on a new connection (see mtWinboxSession.reconnect())
+	def resubscribe(self):
+		try:
+			if self.subscribe():
+				return True
+			error = Exception('Error subscribing to %s again (error %s %s)' % (self.to, self.error, self.error_description))
+		except Exception as e:
+			error = e
+		self.fail(error)
+		return False
+
+	# Fail the subscription, the iterator raises the error once the notifications got are taken
+	def fail(self, error):
+		self.unregister()
+		self.subscribed = False
+		self.failure = error
+
+	# Raise the error of a failed subscription
+	def check(self):
+		if self.failure is not None:
+			raise Exception('Subscription to %s lost: %s' % (self.to, self.failure))
+
+	# Stop taking the notifications; the device has no known request to cancel a subscription,
+	# so the ones still coming are dropped, rather than piling up in the unsolicited messages
+	def unsubscribe(self):
+		self.unregister()
+		self.session.add_listener(self.discard, fallback = True)
+		self.subscribed = False
+
+	# Tell a notification from the subscribed handler
+	def matches(self, result):
+		if result.get_value(SYS_CMD, U32) not in (CMD_NOTIFY, None):
+			return False
+		source = result.get_value(SYS_FROM, U32_ARRAY)
+		return source is not None and list(source) == self.to
+
+	# Drop a notification coming after unsubscribe()
+	def discard(self, result):
+		return self.matches(result)
+
+	# Take a notification out of the unsolicited messages, called from the reading thread
+	def listener(self, result):
+		if not self.matches(result):
+			return False
+		self.notifications.append(result)
+		return True
+
+	# Get the next notification, None if there is none within the session timeout
+	def get(self):
+		if not self.notifications:
+			self.check()
+		try:
+			self.session.pump(lambda: len(self.notifications) > 0)
+		except socket_module.timeout:
+			return None
+		return self.notifications.popleft()
+
+	# Iterate over the notifications until unsubscribed
+	def __iter__(self):
+		while self.subscribed or self.notifications:
+			if self.notifications:
+				yield self.notifications.popleft()
+				continue
+			result = self.get()
+			if result is not None:
+				yield result
+		self.check()
+
+	def __enter__(self):
+		if not self.subscribe():
+			raise Exception('Error subscribing to %s (error %s %s)' % (self.to, self.error, self.error_description))
+		return self
+
+	def __exit__(self, *exc_info):
+		self.unsubscribe()
+
+# mtSubscription over an mtAsyncWinboxSession, an async iterator over the notifications
+class mtAsyncSubscription(mtSubscription):
+	def __init__(self, winbox_session, handler, subhandler = None, sender = (0x00, 0x57)):
+		super().__init__(winbox_session, handler, subhandler, sender)
+		self.notifications = asyncio.Queue()
+
+	def listener(self, result):
+		if not self.matches(result):
+			return False
+		self.notifications.put_nowait(result)
+		return True
+
+	async def subscribe(self):
+		self.register()
+		return self.subscribe_reply(await self.session.request(self.subscribe_request()))
+
+	async def resubscribe(self):
+		try:
+			if await self.subscribe():
+				return True
+			error = Exception('Error subscribing to %s again (error %s %s)' % (self.to, self.error, self.error_description))
+		except Exception as e:
+			error = e
+		self.fail(error)
+		return False
+
+	async def get(self):
+		if self.notifications.empty():
+			self.check()
+		try:
+			return await asyncio.wait_for(self.notifications.get(), self.session.timeout)
+		except asyncio.TimeoutError:
+			return None
+
+	def __aiter__(self):
+		return self
+
+	async def __anext__(self):
+		while self.subscribed or not self.notifications.empty():
+			if not self.notifications.empty():
+				return self.notifications.get_nowait()
+			result = await self.get()
+			if result is not None:
+				return result
+		self.check()
+		raise StopAsyncIteration
+
+	async def __aenter__(self):
+		if not await self.subscribe():
+			raise Exception('Error subscribing to %s (error %s %s)' % (self.to, self.error, self.error_description))
+		return self
+
+	async def __aexit__(self, *exc_info):
+		self.unsubscribe()
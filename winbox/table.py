@@ -0,0 +1,146 @@
+#!/usr/bin/env python3
+
+from winbox.common import *
+from winbox.message import *
+from winbox.packet import *
+
+# Change events passed to the callbacks
+TABLE_ADDED		= 'added'
+TABLE_CHANGED		= 'changed'
+TABLE_REMOVED		= 'removed'
+
+# Get the value of a field of an object (a list of (id, type, value))
+def object_value(obj, param_id, param_type):
+	for id, type, value in obj:
+		if id == param_id and type == param_type:
+			return value
+	return None
+
+# A local mirror of a remote object table (e.g. (0x44, 0x01) for the services), keyed by STD_ID
+# refresh() asks for the objects changed since the last STD_NEXTID when the device has given one,
+# applying the STD_DEAD objects as removals and checking the size against STD_OBJ_COUNT;
+# a device without STD_NEXTID gets a full CMD_GETALL, diffed against the mirror
+class mtTable(object):
+	def __init__(self, winbox_session, handler, subhandler = None, sender = (0x00, 0x57)):
+		self.session = winbox_session.session
+		self.request_id = winbox_session.request_id
+		self.to = (handler,) if subhandler is None else (handler, subhandler)
+		self.sender = sender
+		# STD_ID -> object
+		self.objects = {}
+		self.next_id = None
+		self.callbacks = []
+		self.error = None
+		self.error_description = None
+		# Refreshes done, and the ones that got deltas
+		self.refreshes = 0
+		self.deltas = 0
+
+	# Call callback(event, id, old, new) for every change of the mirror
+	def on_change(self, callback):
+		self.callbacks.append(callback)
+
+	# Build a CMD_GETALL request, asking for the changes since next_id if given
+	def get_all_request(self, next_id = None):
+		self.request_id = self.session.next_request_id()
+		msg = mtMessage()
+		msg.set_reply_expected(True)
+		msg.set_request_id(self.request_id)
+		msg.set_command(CMD_GETALL)
+		msg.set_to(*self.to)
+		msg.set_from(*self.sender)
+		if next_id is not None:
+			msg.add_u32(STD_NEXTID, next_id)
+		return mtPacket(msg.build(), self.request_id)
+
+	# Record a change and tell the callbacks
+	def change(self, changes, event, id, old, new):
+		changes.append((event, id, old, new))
+		for callback in self.callbacks:
+			callback(event, id, old, new)
+
+	# Add or replace an object, or remove it if it is STD_DEAD
+	def apply_object(self, obj, changes):
+		id = object_value(obj, STD_ID, U32)
+		if id is None:
+			return
+		old = self.objects.get(id)
+		if object_value(obj, STD_DEAD, BOOL):
+			if old is not None:
+				del self.objects[id]
+				self.change(changes, TABLE_REMOVED, id, old, None)
+			return
+		self.objects[id] = obj
+		if old is None:
+			self.change(changes, TABLE_ADDED, id, None, obj)
+		elif old != obj:
+			self.change(changes, TABLE_CHANGED, id, old, obj)
+
+	# Replace the mirror with a full snapshot, diffing it against the current objects
+	def apply_snapshot(self, objs, changes):
+		seen = set()
+		for obj in objs:
+			id = object_value(obj, STD_ID, U32)
+			if id is not None:
+				seen.add(id)
+				self.apply_object(obj, changes)
+		for id in [id for id in self.objects if id not in seen]:
+			self.change(changes, TABLE_REMOVED, id, self.objects.pop(id), None)
+
+	# Handle a CMD_GETALL reply, adding to a list of changes, returns False if a delta doesn't add up
+	def get_all_reply(self, result, delta, changes):
+		self.error = result.get_value(SYS_ERRNO, U32)
+		if self.error is not None:
+			self.error_description = result.get_value(SYS_ERRSTR, STRING)
+			raise Exception('Error getting the objects of %s (error %s %s)' % (self.to, self.error, self.error_description))
+		objs = result.get_value(STD_OBJS, MESSAGE_ARRAY) or []
+		next_id = result.get_value(STD_NEXTID, U32)
+		count = result.get_value(STD_OBJ_COUNT, U32)
+		if delta and next_id is not None:
+			for obj in objs:
+				self.apply_object(obj, changes)
+			if count is not None and count != len(self.objects):
+				# Something has been missed, start over with a snapshot
+				self.next_id = None
+				return False
+			self.deltas += 1
+		else:
+			self.apply_snapshot(objs, changes)
+		self.next_id = next_id
+		self.refreshes += 1
+		return True
+
+	# Bring the mirror up to date, returns the list of (event, id, old, new) changes
+	def refresh(self):
+		changes = []
+		if self.next_id is None or not self.get_all_reply(self.session.request(self.get_all_request(self.next_id)), True, changes):
+			self.get_all_reply(self.session.request(self.get_all_request()), False, changes)
+		return changes
+
+	# Apply a notification (see mtSubscription) carrying changed objects, returns the changes
+	def apply_notification(self, result):
+		changes = []
+		objs = result.get_value(STD_OBJS, MESSAGE_ARRAY)
+		if objs is None and result.get_value(STD_ID, U32) is not None:
+			# A single object, without the SYS_* fields
+			objs = [[(id, type, value) for id, type, value in result.items() if id < SYS_TO]]
+		for obj in objs or ():
+			self.apply_object(obj, changes)
+		return changes
+
+	def __len__(self):
+		return len(self.objects)
+
+	def __iter__(self):
+		return iter(self.objects.values())
+
+	def get(self, id):
+		return self.objects.get(id)
+
+# mtTable over an mtAsyncWinboxSession
+class mtAsyncTable(mtTable):
+	async def refresh(self):
+		changes = []
+		if self.next_id is None or not self.get_all_reply(await self.session.request(self.get_all_request(self.next_id)), True, changes):
+			self.get_all_reply(await self.session.request(self.get_all_request()), False, changes)
+		return changes
@@ -1,9 +1,47 @@
 #!/usr/bin/env python3
 
+import asyncio
+import itertools
+import os
+import socket as socket_module
+import threading
+from collections import deque
+from concurrent.futures import Future
+from select import select
 from socket import *
+from time import monotonic
 from winbox.common import *
 from winbox.packet import *
 
+# The size of a reusable receive buffer
+RECV_BUFFER_SIZE = 0x10000
+
+# The request ids given up on remembered, so their late replies are dropped
+EXPIRED_MAX = 1024
+
+# The maximum number of buffers for a single sendmsg() call
+try:
+	IOV_MAX = os.sysconf('SC_IOV_MAX')
+except (AttributeError, ValueError, OSError):
+	IOV_MAX = 1024
+
+# TCP keepalive defaults: idle seconds before the first probe, seconds between the probes, probes to fail
+KEEPALIVE_IDLE		= 60
+KEEPALIVE_INTERVAL	= 10
+KEEPALIVE_COUNT		= 3
+
+# Turn TCP keepalives on for a socket, with the timing options the platform has
+def set_socket_keepalive(sock, idle, interval, count):
+	sock.setsockopt(SOL_SOCKET, SO_KEEPALIVE, 1)
+	# macOS calls the idle option TCP_KEEPALIVE
+	idle_option = getattr(socket_module, 'TCP_KEEPIDLE', getattr(socket_module, 'TCP_KEEPALIVE', None))
+	for option, value in ((idle_option, idle), (getattr(socket_module, 'TCP_KEEPINTVL', None), interval), (getattr(socket_module, 'TCP_KEEPCNT', None), count)):
+		if option is not None:
+			try:
+				sock.setsockopt(IPPROTO_TCP, option, value)
+			except OSError:
+				pass
+
 # mtTCPSession to handle TCP winbox connections
 class mtTCPSession(object):
 	def __init__(self, host, port = None, timeout = None):
@@ -17,6 +55,24 @@ class mtTCPSession(object):
 		else:
 			self.timeout = 15
 		self.ready = False
+		self.decoder = mtStreamDecoder()
+		self.recv_buffer = bytearray(RECV_BUFFER_SIZE)
+		self.send_queue = []
+		self.send_lock = threading.RLock()
+		self.request_ids = itertools.count(1)
+		self.pending = {}
+		# Request ids given up on -> None, oldest first
+		self.expired = {}
+		self.unsolicited = deque()
+		# Callables offered the unsolicited messages first, one returning True takes the message
+		self.listeners = []
+		self.fallback_listeners = []
+		self.reading = False
+		self.condition = threading.Condition()
+		# (idle, interval, count) once set_keepalive() is called, applied to every connection
+		self.keepalive = None
+		# When a message has been received last
+		self.last_activity = monotonic()
 
 	# Connect to a winbox service
 	def connect(self):
@@ -31,7 +87,31 @@ class mtTCPSession(object):
 		except:
 			self.ready = False
 			raise Exception('Connection error to %s:%s' % (self.host, self.port))
+		if self.keepalive is not None:
+			set_socket_keepalive(self.socket, *self.keepalive)
+		self.decoder.reset()
+		self.decoder.messages.clear()
 		self.ready = True
+		self.last_activity = monotonic()
+
+	# Turn TCP keepalives on, for the current connection and the next ones
+	def set_keepalive(self, idle = KEEPALIVE_IDLE, interval = KEEPALIVE_INTERVAL, count = KEEPALIVE_COUNT):
+		self.keepalive = (idle, interval, count)
+		if self.ready:
+			set_socket_keepalive(self.socket, idle, interval, count)
+
+	# Drop the connection and connect again, the pending requests fail
+	def reconnect(self):
+		with self.send_lock:
+			try:
+				self.socket.close()
+			except (AttributeError, OSError):
+				pass
+			self.ready = False
+			self.send_queue = []
+			self.fail_pending(Exception('Connection to %s:%s reset' % (self.host, self.port)))
+			self.unsolicited.clear()
+			self.connect()
 
 	# Send arbitrary bytes
 	def send_bytes(self, bytes):
@@ -43,6 +123,27 @@ class mtTCPSession(object):
 			return False
 		return True
 
+	# Send a list of buffers at once (scatter-gather), without joining them
+	def send_buffers(self, buffers):
+		if not self.ready:
+			raise Exception('Not connected to %s:%s' % (self.host, self.port))
+		if not hasattr(self.socket, 'sendmsg'):
+			return self.send_bytes(b''.join(buffers))
+		views = [memoryview(buffer).cast('B') for buffer in buffers if len(buffer)]
+		index = 0
+		try:
+			while index < len(views):
+				sent = self.socket.sendmsg(views[index:index+IOV_MAX])
+				# Skip the buffers sent completely and trim a partially sent one
+				while index < len(views) and sent >= len(views[index]):
+					sent -= len(views[index])
+					index += 1
+				if sent:
+					views[index] = views[index][sent:]
+		except:
+			return False
+		return True
+
 	# Receive arbitrary bytes
 	def recv_bytes(self, size):
 		if not self.ready:
@@ -55,18 +156,464 @@ class mtTCPSession(object):
 		self.socket.close()
 		self.ready = False
 
-	# Send an mtPacket
+	# Check without blocking whether the connection is still up
+	# While another thread is reading, that thread notices a closed connection by itself;
+	# otherwise the check takes the reader's place so no reader takes the data peeked at
+	def is_alive(self):
+		with self.condition:
+			if not self.ready or self.reading:
+				return self.ready
+			self.reading = True
+		try:
+			readable, writable, failed = select([self.socket], [], [], 0)
+			# Readable with no data means the peer has closed the connection
+			if readable and not self.socket.recv(1, MSG_PEEK | getattr(socket_module, 'MSG_DONTWAIT', 0)):
+				self.ready = False
+		except (BlockingIOError, socket_module.timeout):
+			pass
+		except (OSError, ValueError):
+			self.ready = False
+		finally:
+			with self.condition:
+				self.reading = False
+				self.condition.notify_all()
+		return self.ready
+
+	# Queue an mtPacket to be sent by the next send() or flush() in a single syscall
+	def queue(self, msg):
+		with self.send_lock:
+			self.send_queue.extend(msg.buffers())
+
+	# Send all the queued packets
+	def flush(self):
+		with self.send_lock:
+			buffers = self.send_queue
+			self.send_queue = []
+			return self.send_buffers(buffers)
+
+	# Send an mtPacket (along with the queued ones)
 	def send(self, msg):
-		if not msg.header:
-			msg.add_header()
-		self.send_bytes(msg.raw)
-
-	# Receive an mtPacket
-	def recv(self, size):
-		received_bytes = self.recv_bytes(size)
-		if received_bytes is not None:
-			result = mtPacket(received_bytes)
-			result.remove_header()
+		with self.send_lock:
+			self.queue(msg)
+			return self.flush()
+
+	# Receive a complete M2 message payload (as a memoryview), reading as much as needed
+	def recv_payload(self):
+		if not self.ready:
+			raise Exception('Not connected to %s:%s' % (self.host, self.port))
+		recv_view = memoryview(self.recv_buffer)
+		while not self.decoder.messages:
+			received = self.socket.recv_into(self.recv_buffer)
+			if not received:
+				self.ready = False
+				raise Exception('Connection closed by %s:%s' % (self.host, self.port))
+			self.decoder.feed(recv_view[:received])
+		self.last_activity = monotonic()
+		return self.decoder.messages.popleft()
+
+	# Receive an mtPacket, the size is not needed anymore and kept for compatibility
+	def recv(self, size = None):
+		return mtPacket(self.recv_payload())
+
+	# Get a request id unique for the connection
+	def next_request_id(self):
+		return next(self.request_ids)
+
+	# Send an mtPacket carrying a request id without waiting for the reply
+	# Returns a Future resolved with the parsed reply once it is dispatched by wait()
+	# With flush False the packet is only queued, to go out along with the next one sent
+	def submit(self, msg, flush = True):
+		if msg.request_id is None:
+			raise Exception('The packet has no request id')
+		future = Future()
+		self.pending[msg.request_id] = future
+		if not flush:
+			self.queue(msg)
+		elif not self.send(msg):
+			self.pending.pop(msg.request_id, None)
+			raise Exception('Send error to %s:%s' % (self.host, self.port))
+		return future
+
+	# Receive one message and route it to the future waiting for its request id, stamping the
+	# future with the time the reply was read (future.received),
+	# messages without a pending request id are put to the unsolicited queue
+	def dispatch(self):
+		try:
+			payload = self.recv_payload()
+		except socket_module.timeout:
+			raise
+		except Exception as e:
+			self.fail_pending(e)
+			raise
+		result = mtMessage(payload)
+		result.parse(lazy = True)
+		request_id = result.get_value(SYS_REQID, U32)
+		future = None
+		if request_id is not None:
+			future = self.pending.pop(request_id, None)
+			# A late reply to a request given up on
+			if future is None and self.expired.pop(request_id, False) is None:
+				return
+		if future is None:
+			if not self.notify_listeners(result):
+				self.unsolicited.append(result)
 		else:
-			result = None
-		return result
+			future.received = monotonic()
+			future.set_result(result)
+
+	# Fail all the pending requests (the connection is lost)
+	def fail_pending(self, error):
+		pending = self.pending
+		self.pending = {}
+		for future in pending.values():
+			if not future.done():
+				future.set_exception(error)
+
+	# Offer an unsolicited message to the listeners, then to the fallback ones,
+	# returns True if one has taken it
+	def notify_listeners(self, result):
+		for listener in self.listeners + self.fallback_listeners:
+			if listener(result):
+				return True
+		return False
+
+	# A fallback listener only gets the messages no other listener has taken
+	def add_listener(self, listener, fallback = False):
+		(self.fallback_listeners if fallback else self.listeners).append(listener)
+
+	def remove_listener(self, listener):
+		for listeners in (self.listeners, self.fallback_listeners):
+			if listener in listeners:
+				listeners.remove(listener)
+
+	# Dispatch incoming messages until a given condition is met
+	# Only one thread reads at a time, the others wait for it to route their replies
+	def pump(self, done):
+		with self.condition:
+			while not done() and self.reading:
+				self.condition.wait()
+			if done():
+				return
+			self.reading = True
+		try:
+			while not done():
+				self.dispatch()
+				with self.condition:
+					self.condition.notify_all()
+		finally:
+			with self.condition:
+				self.reading = False
+				self.condition.notify_all()
+
+	# Give up on a request, its reply is dropped if it comes later
+	def expire(self, request_id):
+		if self.pending.pop(request_id, None) is None:
+			return
+		self.expired[request_id] = None
+		if len(self.expired) > EXPIRED_MAX:
+			del self.expired[next(iter(self.expired))]
+
+	# Give up on a submitted request
+	def expire_future(self, future):
+		for request_id, pending in list(self.pending.items()):
+			if pending is future:
+				self.expire(request_id)
+
+	# Wait for a submitted request, returns the parsed reply
+	def wait(self, future):
+		try:
+			self.pump(future.done)
+		except socket_module.timeout:
+			self.expire_future(future)
+			raise
+		return future.result()
+
+	# Get the next unsolicited message, waiting for it if there are none yet
+	def recv_unsolicited(self):
+		self.pump(lambda: len(self.unsolicited) > 0)
+		return self.unsolicited.popleft()
+
+	# Send an mtPacket and receive a reply as a (lazily) parsed mtMessage
+	# A packet without a request id gets the next unsolicited message as a reply
+	def request(self, msg):
+		if msg.request_id is None:
+			self.send(msg)
+			return self.recv_unsolicited()
+		return self.wait(self.submit(msg))
+
+	# Wait until any of the submitted requests gets its reply
+	def wait_any(self, futures):
+		self.pump(lambda: any(future.done() for future in futures))
+
+	# Run the steps of an algorithm shared with mtAsyncTCPSession, yielding the values it hands out
+	# The steps come from a generator yielding (function, *args) for every I/O call, which gets
+	# back the result or has the exception thrown in; a (None, value) step hands out a value
+	# The exit of a caller leaving early is thrown in too, so the steps can still clean up
+	def iterate(self, steps):
+		value = error = None
+		while True:
+			try:
+				step = steps.send(value) if error is None else steps.throw(error)
+			except StopIteration as stop:
+				return stop.value
+			value = error = None
+			try:
+				if step[0] is None:
+					yield step[1]
+				else:
+					value = step[0](*step[1:])
+			except BaseException as e:
+				error = e
+
+	# Run the steps of an algorithm handing out no values (see iterate()), returns its result
+	def run(self, steps):
+		values = self.iterate(steps)
+		try:
+			next(values)
+		except StopIteration as stop:
+			return stop.value
+		values.close()
+		raise Exception('Unexpected value from the steps')
+
+# mtAsyncTCPSession handles TCP winbox connections using asyncio streams
+class mtAsyncTCPSession(object):
+	def __init__(self, host, port = None, timeout = None):
+		self.host = host
+		if port:
+			self.port = port
+		else:
+			self.port = 8291
+		if timeout:
+			self.timeout = timeout
+		else:
+			self.timeout = 15
+		self.ready = False
+		self.reader = None
+		self.writer = None
+		self.decoder = mtStreamDecoder()
+		self.request_ids = itertools.count(1)
+		self.pending = {}
+		self.expired = {}
+		self.unsolicited = None
+		self.listeners = []
+		self.fallback_listeners = []
+		self.reader_task = None
+		self.keepalive = None
+		self.last_activity = monotonic()
+
+	# Connect to a winbox service
+	async def connect(self):
+		try:
+			self.reader, self.writer = await asyncio.wait_for(asyncio.open_connection(self.host, int(self.port)), self.timeout)
+		except:
+			self.ready = False
+			raise Exception('Connection error to %s:%s' % (self.host, self.port))
+		if self.keepalive is not None:
+			set_socket_keepalive(self.writer.get_extra_info('socket'), *self.keepalive)
+		self.decoder.reset()
+		self.decoder.messages.clear()
+		self.unsolicited = asyncio.Queue()
+		self.ready = True
+		self.last_activity = monotonic()
+		self.reader_task = asyncio.ensure_future(self.read_loop())
+
+	# Turn TCP keepalives on, for the current connection and the next ones
+	def set_keepalive(self, idle = KEEPALIVE_IDLE, interval = KEEPALIVE_INTERVAL, count = KEEPALIVE_COUNT):
+		self.keepalive = (idle, interval, count)
+		if self.ready:
+			set_socket_keepalive(self.writer.get_extra_info('socket'), idle, interval, count)
+
+	# The reader task notices a closed connection by itself
+	def is_alive(self):
+		return self.ready and self.reader_task is not None and not self.reader_task.done()
+
+	# Drop the connection and connect again, the pending requests fail
+	async def reconnect(self):
+		await self.close()
+		await self.connect()
+
+	# Close a connection
+	async def close(self):
+		self.ready = False
+		if self.reader_task is not None:
+			self.reader_task.cancel()
+			self.reader_task = None
+		self.fail_pending(Exception('Connection to %s:%s closed' % (self.host, self.port)))
+		if self.writer is not None:
+			self.writer.close()
+			try:
+				await self.writer.wait_closed()
+			except:
+				pass
+
+	# Queue an mtPacket to be written by the next flush()
+	def queue(self, msg):
+		if not self.ready:
+			raise Exception('Not connected to %s:%s' % (self.host, self.port))
+		self.writer.writelines(msg.buffers())
+
+	# Wait until the queued packets are written
+	async def flush(self):
+		await self.writer.drain()
+
+	# Send an mtPacket (along with the queued ones)
+	async def send(self, msg):
+		self.queue(msg)
+		await self.flush()
+
+	# Receive a complete M2 message payload (as a memoryview)
+	async def recv_payload(self):
+		if not self.ready:
+			raise Exception('Not connected to %s:%s' % (self.host, self.port))
+		while not self.decoder.messages:
+			received = await self.reader.read(RECV_BUFFER_SIZE)
+			if not received:
+				self.ready = False
+				raise Exception('Connection closed by %s:%s' % (self.host, self.port))
+			self.decoder.feed(received)
+		self.last_activity = monotonic()
+		return self.decoder.messages.popleft()
+
+	# Read the incoming messages, routing them to the futures waiting for their request ids
+	# (stamped with the time the reply was read, see mtTCPSession.dispatch())
+	async def read_loop(self):
+		try:
+			while True:
+				result = mtMessage(await self.recv_payload())
+				result.parse(lazy = True)
+				request_id = result.get_value(SYS_REQID, U32)
+				future = None
+				if request_id is not None:
+					future = self.pending.pop(request_id, None)
+					if future is None and self.expired.pop(request_id, False) is None:
+						continue
+				if future is None:
+					if not self.notify_listeners(result):
+						self.unsolicited.put_nowait(result)
+				elif not future.done():
+					future.received = monotonic()
+					future.set_result(result)
+		except asyncio.CancelledError:
+			raise
+		except Exception as e:
+			self.ready = False
+			self.fail_pending(e)
+
+	# Fail all the pending requests (the connection is lost)
+	def fail_pending(self, error):
+		pending = self.pending
+		self.pending = {}
+		for future in pending.values():
+			if not future.done():
+				future.set_exception(error)
+
+	# Offer an unsolicited message to the listeners, then to the fallback ones,
+	# returns True if one has taken it
+	def notify_listeners(self, result):
+		for listener in self.listeners + self.fallback_listeners:
+			if listener(result):
+				return True
+		return False
+
+	# A fallback listener only gets the messages no other listener has taken
+	def add_listener(self, listener, fallback = False):
+		(self.fallback_listeners if fallback else self.listeners).append(listener)
+
+	def remove_listener(self, listener):
+		for listeners in (self.listeners, self.fallback_listeners):
+			if listener in listeners:
+				listeners.remove(listener)
+
+	# Get a request id unique for the connection
+	def next_request_id(self):
+		return next(self.request_ids)
+
+	# Send an mtPacket carrying a request id without waiting for the reply
+	# Returns a future resolved with the parsed reply
+	async def submit(self, msg, flush = True):
+		if msg.request_id is None:
+			raise Exception('The packet has no request id')
+		future = asyncio.get_running_loop().create_future()
+		self.pending[msg.request_id] = future
+		try:
+			if flush:
+				await self.send(msg)
+			else:
+				self.queue(msg)
+		except:
+			self.pending.pop(msg.request_id, None)
+			raise
+		return future
+
+	def expire(self, request_id):
+		if self.pending.pop(request_id, None) is None:
+			return
+		self.expired[request_id] = None
+		if len(self.expired) > EXPIRED_MAX:
+			del self.expired[next(iter(self.expired))]
+
+	def expire_future(self, future):
+		for request_id, pending in list(self.pending.items()):
+			if pending is future:
+				self.expire(request_id)
+
+	# Wait for a submitted request, returns the parsed reply
+	async def wait(self, future):
+		try:
+			return await asyncio.wait_for(asyncio.shield(future), self.timeout)
+		except asyncio.TimeoutError:
+			self.expire_future(future)
+			raise
+
+	# Get the next unsolicited message
+	async def recv_unsolicited(self):
+		return await asyncio.wait_for(self.unsolicited.get(), self.timeout)
+
+	# Send an mtPacket and receive a reply as a (lazily) parsed mtMessage
+	# A packet without a request id gets the next unsolicited message as a reply
+	async def request(self, msg):
+		if msg.request_id is None:
+			await self.send(msg)
+			return await self.recv_unsolicited()
+		return await self.wait(await self.submit(msg))
+
+	# Wait until any of the submitted requests gets its reply
+	async def wait_any(self, futures):
+		done, not_done = await asyncio.wait(futures, timeout = self.timeout, return_when = asyncio.FIRST_COMPLETED)
+		if not done:
+			raise socket_module.timeout('Timed out waiting for %s:%s' % (self.host, self.port))
+
+	# Run the steps of an algorithm shared with mtTCPSession (see mtTCPSession.iterate()),
+	# awaiting the I/O calls, as an async generator of the values it hands out
+	async def iterate(self, steps):
+		value = error = None
+		while True:
+			try:
+				step = steps.send(value) if error is None else steps.throw(error)
+			except StopIteration:
+				return
+			value = error = None
+			try:
+				if step[0] is None:
+					yield step[1]
+				else:
+					value = await step[0](*step[1:])
+			except BaseException as e:
+				error = e
+
+	# Run the steps of an algorithm handing out no values, returns its result
+	async def run(self, steps):
+		value = error = None
+		while True:
+			try:
+				step = steps.send(value) if error is None else steps.throw(error)
+			except StopIteration as stop:
+				return stop.value
+			if step[0] is None:
+				steps.close()
+				raise Exception('Unexpected value from the steps')
+			value = error = None
+			try:
+				value = await step[0](*step[1:])
+			except BaseException as e:
+				error = e